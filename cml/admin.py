@@ -3,11 +3,116 @@ from django.contrib import admin
 from .models import *
 
 
+class ExchangeMetricsInline(admin.StackedInline):
+
+    model = ExchangeMetrics
+    can_delete = False
+    readonly_fields = ('seconds', 'items', 'errors', 'bytes', 'peak_memory', 'section_seconds', 'pipeline_seconds',
+                       'item_counts', 'error_counts', 'duplicate_counts', 'commits', 'commit_seconds',
+                       'max_commit_seconds', 'lock_seconds', 'max_lock_seconds')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Exchange)
 class ExchangeAdmin(admin.ModelAdmin):
 
-    list_display = ('exchange_type', 'timestamp', 'user', 'filename')
-    readonly_fields = ('exchange_type', 'timestamp', 'user', 'filename')
+    list_display = ('exchange_type', 'timestamp', 'user', 'filename', 'is_success', 'is_confirmed', 'watermark',
+                    'metrics_seconds', 'metrics_items', 'metrics_errors', 'throughput', 'trend')
+    list_select_related = ('user', 'metrics')
+    list_filter = ('exchange_type', 'is_success')
+    readonly_fields = ('exchange_type', 'timestamp', 'user', 'filename', 'session_key', 'is_success', 'is_confirmed',
+                       'watermark', 'watermark_id', 'exported_ids')
+    inlines = (ExchangeMetricsInline,)
+
+    def has_add_permission(self, request):
+        return False
+
+    @staticmethod
+    def _get_metrics(obj):
+        try:
+            return obj.metrics
+        except ExchangeMetrics.DoesNotExist:
+            return None
+
+    @admin.display(description='seconds')
+    def metrics_seconds(self, obj):
+        metrics = self._get_metrics(obj)
+        return '{:.1f}'.format(metrics.seconds) if metrics else '-'
+
+    @admin.display(description='items')
+    def metrics_items(self, obj):
+        metrics = self._get_metrics(obj)
+        return metrics.items if metrics else '-'
+
+    @admin.display(description='errors')
+    def metrics_errors(self, obj):
+        metrics = self._get_metrics(obj)
+        return metrics.errors if metrics else '-'
+
+    @admin.display(description='items/s')
+    def throughput(self, obj):
+        metrics = self._get_metrics(obj)
+        return '{:.0f}'.format(metrics.items_per_second) if metrics else '-'
+
+    def get_changelist_instance(self, request):
+        changelist = super(ExchangeAdmin, self).get_changelist_instance(request)
+        # the trends of the page in one query
+        exchanges = list(changelist.result_list)
+        trends = ExchangeMetrics.get_trends([metrics for metrics in map(self._get_metrics, exchanges) if metrics])
+        for exchange in exchanges:
+            exchange.metrics_trend = trends.get(getattr(self._get_metrics(exchange), 'pk', None))
+        return changelist
+
+    @admin.display(description='trend')
+    def trend(self, obj):
+        # throughput against the mean of the previous exchanges of the same file
+        trend = getattr(obj, 'metrics_trend', None)
+        if trend is None:
+            return '-'
+        return '{:+.0f}%'.format(trend * 100 - 100)
+
+
+@admin.register(ImportTask)
+class ImportTaskAdmin(admin.ModelAdmin):
+
+    list_display = ('filename', 'status', 'progress', 'user', 'session_key', 'created', 'updated', 'is_reported')
+    readonly_fields = ('filename', 'file_path', 'archive_path', 'user', 'session_key', 'exchange_type', 'status',
+                       'progress', 'message', 'is_reported', 'created', 'updated')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ImportCheckpoint)
+class ImportCheckpointAdmin(admin.ModelAdmin):
+
+    list_display = ('file_key', 'section', 'handled', 'last_id', 'updated')
+    readonly_fields = ('file_key', 'signature', 'section', 'handled', 'last_id', 'updated')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(StoredImage)
+class StoredImageAdmin(admin.ModelAdmin):
+
+    list_display = ('filename', 'content_hash', 'last_used', 'updated')
+    search_fields = ('filename', 'content_hash')
+    readonly_fields = ('filename', 'content_hash', 'last_used', 'updated')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ItemFingerprint)
+class ItemFingerprintAdmin(admin.ModelAdmin):
+
+    list_display = ('item_type', 'item_id', 'fingerprint', 'updated')
+    list_filter = ('item_type',)
+    search_fields = ('item_id',)
+    readonly_fields = ('item_type', 'item_id', 'fingerprint', 'updated')
 
     def has_add_permission(self, request):
         return False
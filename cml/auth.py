@@ -3,9 +3,15 @@
 from __future__ import absolute_import
 import six
 import base64
+import hashlib
+import secrets
+from datetime import timedelta
 
 from django.http import HttpResponse
+from django.utils import timezone
 from django.contrib.auth import authenticate, login
+from .models import ExchangeToken
+from .conf import settings
 
 
 def view_or_basicauth(view, request, test_func, realm = "", *args, **kwargs):
@@ -108,3 +114,69 @@ def has_perm_or_basicauth(perm, realm = ""):
                                      realm, *args, **kwargs)
         return wrapper
     return view_decorator
+
+
+def _get_token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def issue_exchange_token(user):
+    """
+    Stores a new random token of the user, which checkauth hands to 1C as a cookie.
+    The token expires CML_TOKEN_TIMEOUT after it's issued.
+    """
+    now = timezone.now()
+    ExchangeToken.objects.filter(expires__lt=now).delete()
+    token = secrets.token_urlsafe(32)
+    ExchangeToken.objects.create(key=_get_token_key(token), user=user,
+                                 expires=now + timedelta(seconds=settings.CML_TOKEN_TIMEOUT))
+    return token
+
+
+def get_exchange_token_user(token, perm):
+    """
+    Returns the user of a live token if it's active and has the permission, otherwise None.
+    """
+    exchange_token = ExchangeToken.objects.select_related('user').filter(
+        key=_get_token_key(token), expires__gt=timezone.now()).first()
+    if exchange_token is None:
+        return None
+    user = exchange_token.user
+    if not user.is_active or not user.has_perm(perm):
+        return None
+    return user
+
+
+def get_exchange_session_key(request):
+    """
+    The key of the exchange session: the token 1C sent or the Django session key.
+    """
+    return getattr(request, 'cml_token', None) or request.session.session_key or u''
+
+
+def has_perm_or_exchange_token(perm, realm = ""):
+    """
+    Like 'has_perm_or_basicauth', but a request with a live exchange token cookie
+    is let through after a database lookup, without a session or a password check.
+
+    Use:
+
+    @has_perm_or_exchange_token('cml.add_exchange')
+    def your_view:
+        ...
+
+    """
+    def view_decorator(func):
+        def wrapper(request, *args, **kwargs):
+            token = request.COOKIES.get(settings.CML_TOKEN_COOKIE_NAME)
+            if token:
+                user = get_exchange_token_user(token, perm)
+                if user is not None:
+                    request.user = user
+                    request.cml_token = token
+                    return func(request, *args, **kwargs)
+            return view_or_basicauth(func, request,
+                                     lambda u: u.is_authenticated and u.has_perm(perm),
+                                     realm, *args, **kwargs)
+        return wrapper
+    return view_decorator
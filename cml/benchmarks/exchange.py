@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -
+"""
+Runs ImportManager.import_all and ExportManager.iter_xml against a CommerceML package
+with the stand-in pipelines, every case in its own forked process so that the peak
+RSS belongs to that case only.
+"""
+from __future__ import absolute_import
+import io
+import os
+import json
+import time
+import signal
+import resource
+import multiprocessing
+from datetime import datetime
+from django.db import connections
+from django.test.utils import override_settings
+from cml.etree import BACKENDS, LxmlBackend, lxml_etree
+from cml.utils import ImportManager, ExportManager
+from cml.benchmarks import pipelines
+
+BENCHMARK_SETTINGS = {
+    'CML_PROJECT_PIPELINES': 'cml.benchmarks.pipelines',
+    'CML_USE_FINGERPRINTS': False,
+}
+
+
+def _get_peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure_import(file_path, extra_settings=None):
+    options = dict(BENCHMARK_SETTINGS, **(extra_settings or {}))
+    with override_settings(**options):
+        import_manager = ImportManager(file_path)
+        started = time.time()
+        try:
+            success = import_manager.import_all()
+        except Exception:
+            success = False
+        seconds = time.time() - started
+    items = sum(import_manager.item_processor.processed.values())
+    return {
+        'case': u'import {}'.format(os.path.basename(file_path)),
+        'success': success,
+        'bytes': os.path.getsize(file_path),
+        'items': items,
+        'seconds': seconds,
+        'items_per_second': items / seconds if seconds else 0,
+        'sections': dict(import_manager.stats['seconds']),
+        'peak_rss_kb': _get_peak_rss(),
+    }
+
+
+def measure_export(orders, extra_settings=None):
+    pipelines.EXPORT_ORDERS = orders
+    options = dict(BENCHMARK_SETTINGS, **(extra_settings or {}))
+    with override_settings(**options):
+        export_manager = ExportManager()
+        started = time.time()
+        first_byte_seconds = None
+        size = 0
+        for chunk in export_manager.iter_xml():
+            if first_byte_seconds is None:
+                first_byte_seconds = time.time() - started
+            size += len(chunk)
+        seconds = time.time() - started
+    return {
+        'case': u'export {} orders'.format(orders),
+        'success': True,
+        'bytes': size,
+        'items': orders,
+        'seconds': seconds,
+        'items_per_second': orders / seconds if seconds else 0,
+        'sections': {u'Документ': seconds},
+        'first_byte_seconds': first_byte_seconds,
+        'peak_rss_kb': _get_peak_rss(),
+    }
+
+
+def run_in_process(func, *args):
+    # the forked process must not share the connection
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def run(file_paths, orders, extra_settings=None):
+    results = [run_in_process(measure_import, file_path, extra_settings) for file_path in file_paths]
+    results.append(run_in_process(measure_export, orders, extra_settings))
+    return results
+
+
+def import_until_killed(file_path, kill_after, extra_settings=None):
+    pipelines.KILL_AFTER = kill_after
+    options = dict(BENCHMARK_SETTINGS, **(extra_settings or {}))
+    with override_settings(**options):
+        ImportManager(file_path).import_all()
+
+
+def run_resume(file_paths, kill_after, extra_settings=None):
+    """
+    Kills the import of every file after kill_after items, as a worker could die, and imports
+    it again: the retry goes on from the last checkpoint and gets only the items after it.
+    """
+    results = []
+    for file_path in file_paths:
+        connections.close_all()
+        process = multiprocessing.get_context('fork').Process(target=import_until_killed,
+                                                               args=(file_path, kill_after, extra_settings))
+        process.start()
+        process.join()
+        result = run_in_process(measure_import, file_path, extra_settings)
+        results.append(dict(result, case=u'resume {}'.format(os.path.basename(file_path)),
+                            killed_after=kill_after if process.exitcode == -signal.SIGKILL else None))
+    return results
+
+
+def get_backend_names():
+    return [name for name in sorted(BACKENDS) if name != LxmlBackend.name or lxml_etree is not None]
+
+
+def run_backends(file_paths, orders, extra_settings=None):
+    """
+    Runs the cases with every installed XML backend, the case names get the backend name.
+    """
+    results = []
+    for backend_name in get_backend_names():
+        backend_settings = dict(extra_settings or {}, CML_XML_BACKEND=backend_name, CML_EXPORT_XML_BACKEND=backend_name)
+        for result in run(file_paths, orders, backend_settings):
+            results.append(dict(result, case=u'{} [{}]'.format(result['case'], backend_name), backend=backend_name))
+    return results
+
+
+def load_results(results_path):
+    """
+    Returns the last saved result of every case.
+    """
+    last_results = {}
+    if not os.path.exists(results_path):
+        return last_results
+    with io.open(results_path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                last_results[result['case']] = result
+    return last_results
+
+
+def save_results(results_path, results):
+    timestamp = datetime.now().isoformat()
+    with io.open(results_path, 'a', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(dict(result, timestamp=timestamp), ensure_ascii=False) + u'\n')
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -
+"""
+Writes synthetic CommerceML 2.05 packages (import.xml, offers.xml, orders.xml)
+shaped like the 1C exports, streaming them to disk whatever their size.
+"""
+from __future__ import absolute_import
+import io
+import os
+import random
+from datetime import date
+from xml.sax.saxutils import escape
+
+SKUS = (
+    (u'796', u'Штука', u'PCE', u'шт'),
+    (u'166', u'Килограмм', u'KGM', u'кг'),
+    (u'006', u'Метр', u'MTR', u'м'),
+)
+TAX_RATES = (u'20', u'10', u'0')
+PRICE_TYPES = (u'Розничная', u'Оптовая')
+VARIANTS_PER_PROPERTY = 10
+
+
+def _id(prefix, index):
+    return u'{}-{:08d}-0000-0000-0000-000000000000'.format(prefix, index)
+
+
+def _header(f):
+    f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write(u'<КоммерческаяИнформация ВерсияСхемы="2.05" ДатаФормирования="{}">\n'.format(date.today()))
+
+
+def _sku(f, sku):
+    code, name_full, abbr, name = sku
+    f.write(u'<БазоваяЕдиница Код="{}" НаименованиеПолное="{}" МеждународноеСокращение="{}">{}</БазоваяЕдиница>'
+            .format(code, name_full, abbr, name))
+
+
+def write_import(file_path, groups, properties, products, rnd):
+    with io.open(file_path, 'w', encoding='utf-8') as f:
+        _header(f)
+        f.write(u'<Классификатор><Ид>{}</Ид><Наименование>Классификатор</Наименование><Группы>'
+                .format(_id(u'cls', 0)))
+        for index in range(groups):
+            f.write(u'<Группа><Ид>{}</Ид><Наименование>Группа {}</Наименование><Группы>'
+                    .format(_id(u'grp', index), index))
+            f.write(u'<Группа><Ид>{}</Ид><Наименование>Подгруппа {}</Наименование></Группа>'
+                    .format(_id(u'sub', index), index))
+            f.write(u'</Группы></Группа>\n')
+        f.write(u'</Группы><Свойства>')
+        for index in range(properties):
+            f.write(u'<Свойство><Ид>{}</Ид><Наименование>Свойство {}</Наименование>'
+                    u'<ТипЗначений>Справочник</ТипЗначений><ВариантыЗначений>'.format(_id(u'prp', index), index))
+            for variant in range(VARIANTS_PER_PROPERTY):
+                f.write(u'<Справочник><ИдЗначения>{}</ИдЗначения><Значение>Значение {}</Значение></Справочник>'
+                        .format(_id(u'v{:03d}'.format(variant), index), variant))
+            f.write(u'</ВариантыЗначений></Свойство>\n')
+        f.write(u'</Свойства></Классификатор>\n')
+        f.write(u'<Каталог СодержитТолькоИзменения="false"><Ид>{}</Ид><ИдКлассификатора>{}</ИдКлассификатора>'
+                u'<Наименование>Каталог товаров</Наименование><Товары>\n'.format(_id(u'cat', 0), _id(u'cls', 0)))
+        for index in range(products):
+            f.write(u'<Товар><Ид>{}</Ид><Артикул>ART-{}</Артикул><Наименование>{}</Наименование>'
+                    .format(_id(u'prd', index), index, escape(u'Товар № {} "Синтетический" & Co'.format(index))))
+            _sku(f, rnd.choice(SKUS))
+            f.write(u'<Группы><Ид>{}</Ид></Группы>'.format(_id(u'sub', rnd.randrange(max(groups, 1)))))
+            f.write(u'<Описание>Описание товара {}</Описание>'.format(index))
+            f.write(u'<Картинка>import_files/{0:02d}/{1}.jpg</Картинка>'.format(index % 100, _id(u'prd', index)))
+            f.write(u'<ЗначенияСвойств>')
+            for property_index in rnd.sample(range(properties), min(properties, 5)):
+                f.write(u'<ЗначенияСвойства><Ид>{}</Ид><Значение>{}</Значение></ЗначенияСвойства>'.format(
+                    _id(u'prp', property_index),
+                    _id(u'v{:03d}'.format(rnd.randrange(VARIANTS_PER_PROPERTY)), property_index)))
+            f.write(u'</ЗначенияСвойств><СтавкиНалогов><СтавкаНалога><Наименование>НДС</Наименование>'
+                    u'<Ставка>{}</Ставка></СтавкаНалога></СтавкиНалогов>'.format(rnd.choice(TAX_RATES)))
+            f.write(u'<ЗначенияРеквизитов>'
+                    u'<ЗначениеРеквизита><Наименование>ВидНоменклатуры</Наименование><Значение>Товар</Значение>'
+                    u'</ЗначениеРеквизита><ЗначениеРеквизита><Наименование>Вес</Наименование><Значение>{}'
+                    u'</Значение></ЗначениеРеквизита></ЗначенияРеквизитов></Товар>\n'.format(rnd.randrange(1, 100)))
+        f.write(u'</Товары></Каталог>\n</КоммерческаяИнформация>\n')
+
+
+def write_offers(file_path, offers, rnd):
+    with io.open(file_path, 'w', encoding='utf-8') as f:
+        _header(f)
+        f.write(u'<ПакетПредложений СодержитТолькоИзменения="false"><Ид>{}#</Ид>'
+                u'<Наименование>Пакет предложений</Наименование><ТипыЦен>'.format(_id(u'cat', 0)))
+        for index, name in enumerate(PRICE_TYPES):
+            f.write(u'<ТипЦены><Ид>{}</Ид><Наименование>{}</Наименование><Валюта>RUB</Валюта>'
+                    u'<Налог><Наименование>НДС</Наименование><УчтеноВСумме>true</УчтеноВСумме></Налог></ТипЦены>'
+                    .format(_id(u'prt', index), name))
+        f.write(u'</ТипыЦен><Предложения>\n')
+        for index in range(offers):
+            f.write(u'<Предложение><Ид>{}</Ид><Наименование>Товар № {}</Наименование>'
+                    .format(_id(u'prd', index), index))
+            sku = rnd.choice(SKUS)
+            _sku(f, sku)
+            f.write(u'<Цены>')
+            price = rnd.randrange(100, 100000)
+            for price_index in range(len(PRICE_TYPES)):
+                f.write(u'<Цена><Представление>{0}.00 RUB за {1}</Представление><ИдТипаЦены>{2}</ИдТипаЦены>'
+                        u'<ЦенаЗаЕдиницу>{0}.00</ЦенаЗаЕдиницу><Валюта>RUB</Валюта><Единица>{1}</Единица>'
+                        u'<Коэффициент>1</Коэффициент></Цена>'
+                        .format(price - price_index * price // 10, sku[3], _id(u'prt', price_index)))
+            f.write(u'</Цены><Количество>{}</Количество></Предложение>\n'.format(rnd.randrange(1000)))
+        f.write(u'</Предложения></ПакетПредложений>\n</КоммерческаяИнформация>\n')
+
+
+def write_orders(file_path, orders, rnd):
+    with io.open(file_path, 'w', encoding='utf-8') as f:
+        _header(f)
+        for index in range(orders):
+            f.write(u'<Документ><Ид>{0}</Ид><Номер>{0}</Номер><Дата>{1}</Дата><ХозОперация>Заказ товара'
+                    u'</ХозОперация><Роль>Продавец</Роль><Валюта>RUB</Валюта><Курс>1</Курс><Сумма>{2}</Сумма>'
+                    .format(index, date.today(), rnd.randrange(100, 100000)))
+            f.write(u'<Контрагенты><Контрагент><Ид>{0}</Ид><Наименование>Покупатель {0}</Наименование>'
+                    u'<ПолноеНаименование>Покупатель {0}</ПолноеНаименование><Роль>Покупатель</Роль>'
+                    u'</Контрагент></Контрагенты><Время>12:00:00</Время><Товары>'.format(index))
+            for item_index in range(rnd.randrange(1, 6)):
+                f.write(u'<Товар><Ид>{}</Ид><Наименование>Товар № {}</Наименование>'
+                        .format(_id(u'prd', item_index), item_index))
+                _sku(f, SKUS[0])
+                f.write(u'<ЦенаЗаЕдиницу>100</ЦенаЗаЕдиницу><Количество>1</Количество><Сумма>100</Сумма></Товар>')
+            f.write(u'</Товары><ЗначенияРеквизитов><ЗначениеРеквизита><Наименование>Статус заказа</Наименование>'
+                    u'<Значение>Новый</Значение></ЗначениеРеквизита></ЗначенияРеквизитов></Документ>\n')
+        f.write(u'</КоммерческаяИнформация>\n')
+
+
+def generate(dst_dir, groups=100, properties=50, products=10000, offers=None, orders=1000, seed=0):
+    """
+    Writes the package files into dst_dir and returns {file name: file path}.
+    """
+    rnd = random.Random(seed)
+    offers = products if offers is None else offers
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    file_paths = {
+        u'import.xml': os.path.join(dst_dir, u'import.xml'),
+        u'offers.xml': os.path.join(dst_dir, u'offers.xml'),
+        u'orders.xml': os.path.join(dst_dir, u'orders.xml'),
+    }
+    write_import(file_paths[u'import.xml'], groups, properties, products, rnd)
+    write_offers(file_paths[u'offers.xml'], offers, rnd)
+    write_orders(file_paths[u'orders.xml'], orders, rnd)
+    return file_paths
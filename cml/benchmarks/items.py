@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -
+"""
+Measures the memory taken by the items of an offers pack: the dict-backed items
+keeping their XML element (as they used to be) against the slot-based ones.
+"""
+from __future__ import absolute_import
+import gc
+import tracemalloc
+from decimal import Decimal
+from xml.etree import ElementTree as ET
+from django.test.utils import override_settings
+from cml.items import Offer, Price
+
+OFFER_XML = u'''<Предложение><Ид>{id}</Ид><Наименование>Товар {id}</Наименование>
+<БазоваяЕдиница Код="796" НаименованиеПолное="Штука" МеждународноеСокращение="PCE">шт</БазоваяЕдиница>
+<Цены><Цена><Представление>100 RUB за шт</Представление><ИдТипаЦены>price-type</ИдТипаЦены>
+<ЦенаЗаЕдиницу>100.00</ЦенаЗаЕдиницу><Валюта>RUB</Валюта><Единица>шт</Единица><Коэффициент>1</Коэффициент>
+</Цена></Цены></Предложение>'''
+
+
+class DictOffer(object):
+
+    def __init__(self, xml_element=None):
+        self.xml_element = xml_element
+        self.id = u''
+        self.name = u''
+        self.sku_id = u''
+        self.prices = []
+
+
+class DictPrice(object):
+
+    def __init__(self, xml_element=None):
+        self.xml_element = xml_element
+        self.representation = u''
+        self.price_type_id = u''
+        self.price_for_sku = Decimal()
+        self.currency_name = u''
+        self.sku_name = u''
+        self.sku_ratio = Decimal()
+
+
+def _build_offer(offer_class, price_class, index):
+    offer_element = ET.fromstring(OFFER_XML.format(id=index))
+    offer = offer_class(offer_element)
+    offer.id = offer_element.findtext(u'Ид')
+    offer.name = offer_element.findtext(u'Наименование')
+    offer.sku_id = u'796'
+    price_element = offer_element.find(u'Цены/Цена')
+    price = price_class(price_element)
+    price.representation = price_element.findtext(u'Представление')
+    price.price_type_id = price_element.findtext(u'ИдТипаЦены')
+    price.price_for_sku = Decimal(price_element.findtext(u'ЦенаЗаЕдиницу'))
+    price.currency_name = price_element.findtext(u'Валюта')
+    price.sku_name = price_element.findtext(u'Единица')
+    price.sku_ratio = Decimal(price_element.findtext(u'Коэффициент'))
+    offer.prices.append(price)
+    return offer
+
+
+def measure(offer_class, price_class, count):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    offers = [_build_offer(offer_class, price_class, index) for index in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del offers
+    return size // count
+
+
+def run(count):
+    """
+    Returns [(variant, bytes per offer)].
+    """
+    results = [(u'dict items with XML', measure(DictOffer, DictPrice, count))]
+    with override_settings(CML_KEEP_XML_ELEMENTS=True):
+        results.append((u'slot items with XML', measure(Offer, Price, count)))
+    with override_settings(CML_KEEP_XML_ELEMENTS=False):
+        results.append((u'slot items', measure(Offer, Price, count)))
+    return results
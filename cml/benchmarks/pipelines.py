@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -
+"""
+Stand-in project pipelines for the benchmarks: they count the items and keep nothing.
+"""
+from __future__ import absolute_import
+import os
+import time
+import signal
+from datetime import datetime
+from decimal import Decimal
+from cml.items import Order, OrderItem
+
+# the number of orders OrderPipeline yields for the export
+EXPORT_ORDERS = 1000
+# seconds every item takes to "write", a stand-in for the database round trip
+WRITE_DELAY = 0
+# the process is killed once the pipelines got that many items, as a worker could die
+KILL_AFTER = 0
+PROCESSED = 0
+
+
+class CountingPipeline(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def process_item(self, item):
+        global PROCESSED
+        self.count += 1
+        PROCESSED += 1
+        if WRITE_DELAY:
+            time.sleep(WRITE_DELAY)
+        if KILL_AFTER and PROCESSED >= KILL_AFTER:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+
+class GroupPipeline(CountingPipeline):
+    pass
+
+
+class PropertyPipeline(CountingPipeline):
+    pass
+
+
+class PropertyVariantPipeline(CountingPipeline):
+    pass
+
+
+class SkuPipeline(CountingPipeline):
+    pass
+
+
+class TaxPipeline(CountingPipeline):
+    pass
+
+
+class ProductPipeline(CountingPipeline):
+    pass
+
+
+class PriceTypePipeline(CountingPipeline):
+    pass
+
+
+class OfferPipeline(CountingPipeline):
+    pass
+
+
+class OrderPipeline(CountingPipeline):
+
+    def yield_item(self):
+        for index in range(EXPORT_ORDERS):
+            order = Order()
+            order.id = index
+            order.number = index
+            order.currency_name = u'RUB'
+            order.currency_rate = Decimal(1)
+            order.sum = Decimal(300)
+            order.client.id = index
+            order.client.name = u'Покупатель {}'.format(index)
+            order.updated_at = datetime.now()
+            for item_index in range(3):
+                order_item = OrderItem()
+                order_item.id = u'prd-{}'.format(item_index)
+                order_item.name = u'Товар № {}'.format(item_index)
+                order_item.sku.id = u'796'
+                order_item.sku.name = u'шт'
+                order_item.sku.name_full = u'Штука'
+                order_item.sku.international_abbr = u'PCE'
+                order_item.price = Decimal(100)
+                order_item.quant = Decimal(1)
+                order_item.sum = Decimal(100)
+                order.items.append(order_item)
+            yield order
+
+    def flush(self):
+        pass
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -
+"""
+Replays a bundle recorded by cml.recording against a server as 1C would,
+to load-test the exchange end to end. Credentials aren't recorded, the replay
+logs in with its own.
+"""
+from __future__ import absolute_import
+import io
+import os
+import json
+import math
+import time
+import base64
+import zipfile
+import posixpath
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.request import Request, urlopen
+from ..recording import REQUESTS_FILE_NAME, BODIES_DIR_NAME
+
+PERCENTILES = (50, 90, 99)
+
+
+def load_sessions(bundle_dir):
+    """
+    Returns the recorded requests grouped by the exchange session, in the order the sessions started.
+    """
+    sessions = OrderedDict()
+    with io.open(os.path.join(bundle_dir, REQUESTS_FILE_NAME), encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                sessions.setdefault(record['session'], []).append(record)
+    return list(sessions.values())
+
+
+def get_route(record):
+    return record['params'].get('type', u''), record['params'].get('mode', u'')
+
+
+class ReplayClient(object):
+    """
+    Replays sessions against url with the credentials: the requests go one by one
+    with the recorded pauses divided by speed (0 for no pauses), an import is
+    repeated while it answers "progress" like 1C does.
+    """
+
+    def __init__(self, bundle_dir, url, username, password, speed=1.0, timeout=600,
+                 response_success='success', response_progress='progress', response_error='failure'):
+        self.bundle_dir = bundle_dir
+        self.url = url
+        self.authorization = 'Basic ' + base64.b64encode(
+            u'{}:{}'.format(username, password).encode('utf-8')).decode('ascii')
+        self.speed = speed
+        self.timeout = timeout
+        self.response_success = response_success
+        self.response_progress = response_progress
+        self.response_error = response_error
+
+    def replay(self, sessions, concurrency=1):
+        """
+        Returns {(type, mode): [(seconds, success), ...]} of all the requests sent.
+        With concurrency the files of every session get a prefix of their own, so the
+        sessions replayed at once (e.g. repeats of one) don't overwrite each other's files.
+        """
+        prefixes = [u''] * len(sessions)
+        if concurrency > 1:
+            for records in sessions:
+                check_renamable(records)
+            prefixes = [u'replay{}-'.format(index) for index in range(len(sessions))]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            session_results = list(executor.map(self.replay_session, sessions, prefixes))
+        results = {}
+        for session_result in session_results:
+            for route, seconds, success in session_result:
+                results.setdefault(route, []).append((seconds, success))
+        return results
+
+    def replay_session(self, records, prefix=u''):
+        results = []
+        cookie = None
+        previous_started = None
+        for record in records:
+            if record['result'] == self.response_progress:
+                # a repeat, it's done below as long as the server asks for it
+                continue
+            if previous_started is not None and self.speed:
+                time.sleep(max(record['started'] - previous_started, 0) / self.speed)
+            previous_started = record['started']
+            route = get_route(record)
+            while True:
+                started = time.time()
+                status_code, content = self._send(record, cookie, prefix)
+                seconds = time.time() - started
+                lines = content.decode('utf-8', 'replace').split(u'\n')
+                if lines[0] != self.response_progress:
+                    break
+                results.append((route, seconds, True))
+            success = status_code == 200 and lines[0] != self.response_error
+            results.append((route, seconds, success))
+            if route[1] == u'checkauth' and lines[0] == self.response_success and len(lines) > 2:
+                # the exchange token
+                cookie = u'{}={}'.format(lines[1], lines[2])
+        return results
+
+    def _send(self, record, cookie, prefix=u''):
+        data = None
+        if record['body']:
+            with open(os.path.join(self.bundle_dir, BODIES_DIR_NAME, record['body']), 'rb') as f:
+                data = f.read()
+        params = record['params']
+        if prefix and params.get('filename'):
+            params = OrderedDict(params, filename=prefix + params['filename'])
+            if data is not None and is_zip_name(params['filename']):
+                data = rename_archive_members(data, prefix)
+        request = Request(u'{}?{}'.format(self.url, urlencode(params)), data=data, method=record['method'])
+        if data is not None:
+            request.add_header('Content-Type', 'application/octet-stream')
+        if cookie is not None:
+            request.add_header('Cookie', cookie)
+        elif get_route(record)[1] == u'checkauth':
+            request.add_header('Authorization', self.authorization)
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            return e.code, e.read()
+        with response:
+            return response.getcode(), response.read()
+
+
+def is_zip_name(filename):
+    return filename.lower().endswith(u'.zip')
+
+
+def check_renamable(records):
+    """
+    Raises ValueError if the files of the session can't get a prefix: the XML files
+    of a zip package are renamed inside it, which can't be done to a part of it.
+    """
+    parts = Counter(record['params'].get('filename') for record in records
+                    if get_route(record)[1] == u'file' and record['body'])
+    for filename, count in parts.items():
+        if filename and is_zip_name(filename) and count > 1:
+            raise ValueError('Zip package {} is uploaded in {} parts, the session can\'t be replayed '
+                             'concurrently'.format(filename, count))
+
+
+def rename_archive_members(data, prefix):
+    """
+    Returns the zip package data with prefix added to the names of its XML files,
+    the import requests ask for them with the prefix.
+    """
+    renamed = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as src, zipfile.ZipFile(renamed, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            name = info.filename
+            if name.lower().endswith(u'.xml'):
+                directory, filename = posixpath.split(name)
+                name = posixpath.join(directory, prefix + filename)
+            dst.writestr(name, src.read(info))
+    return renamed.getvalue()
+
+
+def get_percentile(sorted_values, percent):
+    # nearest rank
+    return sorted_values[max(int(math.ceil(percent / 100.0 * len(sorted_values))) - 1, 0)]
+
+
+def summarize(results):
+    """
+    Returns [(route, requests, failures, {percentile: seconds}, max seconds)] by route.
+    """
+    summary = []
+    for route, route_results in sorted(results.items()):
+        seconds = sorted(result_seconds for result_seconds, success in route_results)
+        failures = sum(1 for result_seconds, success in route_results if not success)
+        percentiles = OrderedDict((percent, get_percentile(seconds, percent)) for percent in PERCENTILES)
+        summary.append((route, len(route_results), failures, percentiles, seconds[-1]))
+    return summary
@@ -10,9 +10,87 @@ class CMLAppCong(AppConf):
     RESPONSE_ERROR = 'failure'
 
     MAX_EXEC_TIME = 60
+
+    # the requests of a lane (see cml.scheduler) served at once across the processes, 0 for no limit;
+    # an import package holds the slot of the request that started it until it's done, so over the
+    # limit no import is started and the catalogue imports answer "progress" right away, they do too
+    # while the sale lane is busy
+    LANE_LIMITS = {'sale': 0, 'catalog': 2}
+    LANE_SLOT_TIMEOUT = 10 * 60
+    # celery queues of the imports by lane, None for the default one; to keep the documents from
+    # waiting behind the catalogue set e.g. {'sale': 'cml_sale', 'catalog': None} and run a worker
+    # for it next to the usual one (celery worker -Q cml_sale), without one the sale imports never run
+    LANE_QUEUES = {'sale': None, 'catalog': None}
+    # a file isn't imported by two tasks at once, the lock of a stuck task expires after that;
+    # a running import refreshes its tasks, the ones not refreshed for that long are imported again
+    IMPORT_LOCK_TIMEOUT = 10 * 60
     USE_ZIP = False
-    FILE_LIMIT = 0
+    FILE_LIMIT = 10 * 1024 * 1024
+
+    # checkauth gives 1C a token cookie, the requests with it skip the session and password checks;
+    # the token expires that long after checkauth, so an exchange has to finish within it
+    TOKEN_COOKIE_NAME = 'cml_exchange_token'
+    TOKEN_TIMEOUT = 3 * 60 * 60
 
     UPLOAD_ROOT = os.path.join(settings.MEDIA_ROOT, 'cml', 'tmp')
 
+    # the exchange requests are recorded into the replay bundle in that directory if it's set,
+    # see the cmlreplay command; the uploaded files are recorded too
+    RECORD_ROOT = None
+
     DELETE_FILES_AFTER_IMPORT = True
+
+    # the files of a package are imported in one transaction, their statuses show after it's committed;
+    # sqlite takes no other writes meanwhile, so no progress either and longer packages look stale
+    ATOMIC_PACKAGES = False
+
+    # product pictures are kept once per content under IMAGE_ROOT, see cml.utils.ImageStore
+    USE_IMAGE_STORE = True
+    IMAGE_ROOT = os.path.join(settings.MEDIA_ROOT, 'cml', 'images')
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+    BATCH_SIZE = 1000
+
+    # the pipeline calls of an import are committed in transactions of that many items of the
+    # default database, every call in its own savepoint, 0 leaves the transactions to the pipelines
+    TRANSACTION_CHUNK_SIZE = 0
+
+    # an import saves its position every that many handled elements and a retry of
+    # the same file continues from there, 0 turns it off
+    CHECKPOINT_INTERVAL = 5000
+
+    # the ElementTree implementation: 'lxml', 'stdlib' or 'auto' for lxml if it's installed;
+    # lxml parses and serializes faster, but the import handlers are slower with its elements,
+    # compare them on your files with cmlbenchmark backends
+    XML_BACKEND = 'stdlib'
+    EXPORT_XML_BACKEND = 'auto'
+
+    # items keep their xml_element for the pipelines only if it's on, the elements of the
+    # items batched for process_items stay in memory until their batch is written
+    KEEP_XML_ELEMENTS = False
+
+    # skip the items that didn't change since the last import
+    USE_FINGERPRINTS = True
+
+    # if the offer pipeline has update_prices/update_stocks, the offers of the packs with
+    # only changes (or of every pack if it's off) are passed to them in columns instead of items
+    OFFERS_UPDATE_ONLY_CHANGES = True
+
+    # products and offers are parsed by a pool of that many processes if it's more than 1,
+    # their items come to the pipelines without xml_element then; the imports have to run in
+    # the main thread of a process for that, e.g. in a prefork (default) Celery worker, not in
+    # a thread of the web process when there is no broker or in a threads pool worker
+    IMPORT_PROCESSES = 0
+    IMPORT_CHUNK_SIZE = 500
+
+    # the pipelines are called by that many writer threads while the file is parsed if it's
+    # more than 0 (and CML_KEEP_XML_ELEMENTS is off), the parser waits while a writer has
+    # IMPORT_QUEUE_SIZE items queued
+    IMPORT_WRITERS = 0
+    IMPORT_QUEUE_SIZE = 2000
+
+    # the most 1C id to primary key references kept per item type
+    REFERENCE_CACHE_SIZE = 100000
+
+    # the most orders sent to 1C by one sale/query
+    EXPORT_BATCH_SIZE = 500
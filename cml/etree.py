@@ -0,0 +1,90 @@
+"""
+ElementTree backends of the imports and exports: lxml if it's installed,
+otherwise the standard library (its C accelerator is used by itself).
+Both give elements with the same API as far as cml uses it.
+"""
+from __future__ import absolute_import
+import logging
+from xml.etree import ElementTree
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StdlibBackend(object):
+
+    name = 'stdlib'
+
+    @staticmethod
+    def iterparse(f, events):
+        return ElementTree.iterparse(f, events=events)
+
+    @staticmethod
+    def fromstring(data):
+        return ElementTree.fromstring(data)
+
+    @staticmethod
+    def tostring(element, encoding):
+        return ElementTree.tostring(element, encoding=encoding)
+
+    @staticmethod
+    def Element(tag):
+        return ElementTree.Element(tag)
+
+    @staticmethod
+    def SubElement(parent, tag):
+        return ElementTree.SubElement(parent, tag)
+
+
+class LxmlBackend(object):
+
+    name = 'lxml'
+
+    @staticmethod
+    def iterparse(f, events):
+        # descriptions and pictures of 1C may be over the libxml2 limit of 10 MB per text node,
+        # comments would come up as children of the handled elements
+        return lxml_etree.iterparse(f, events=events, huge_tree=True, remove_comments=True, remove_pis=True)
+
+    @staticmethod
+    def fromstring(data):
+        return lxml_etree.fromstring(data)
+
+    @staticmethod
+    def tostring(element, encoding):
+        return lxml_etree.tostring(element, encoding=encoding)
+
+    @staticmethod
+    def Element(tag):
+        return lxml_etree.Element(tag)
+
+    @staticmethod
+    def SubElement(parent, tag):
+        return lxml_etree.SubElement(parent, tag)
+
+
+BACKENDS = {
+    StdlibBackend.name: StdlibBackend,
+    LxmlBackend.name: LxmlBackend,
+}
+
+
+def get_backend(name=None):
+    """
+    Returns the backend named by name or CML_XML_BACKEND: 'lxml', 'stdlib' or 'auto'
+    for lxml if it's installed. lxml falls back to the standard library if it's not.
+    """
+    name = name or settings.CML_XML_BACKEND
+    if name == 'auto':
+        name = LxmlBackend.name if lxml_etree is not None else StdlibBackend.name
+    if name == LxmlBackend.name and lxml_etree is None:
+        logger.error('lxml is not installed, parsing with the standard library')
+        name = StdlibBackend.name
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown XML backend {}'.format(name))
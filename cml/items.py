@@ -1,27 +1,135 @@
 # -*- coding: utf-8 -
 from __future__ import absolute_import
+import hashlib
 from decimal import Decimal
 from datetime import datetime
+from .conf import settings
 
-PROCESSED_ITEMS = ('Group', 'PropertyVariant', 'Property', 'PropertyVariant', 'Sku', 'Tax', 'Product', 'Offer', 'Order')
+# ordered so that the referenced items go before the items referencing them
+PROCESSED_ITEMS = ('Group', 'Property', 'PropertyVariant', 'Sku', 'Tax', 'Product', 'PriceType', 'Offer', 'Order')
+
+# the types of a section referencing each other, the writers of an import never split them
+WRITER_GROUPS = (('Group',), ('Property', 'PropertyVariant'), ('Sku', 'Tax', 'Product'), ('PriceType', 'Offer'),
+                 ('Order',))
+
+# repeated in every product and offer, an import passes each distinct one to the pipelines once
+DEDUPLICATED_ITEMS = ('Sku', 'Tax')
+
+
+def _get_value_state(value):
+    if isinstance(value, BaseItem):
+        return value.get_state()
+    if isinstance(value, (list, tuple)):
+        return tuple(_get_value_state(v) for v in value)
+    return value
+
+
+def _get_value_snapshot(value):
+    if isinstance(value, BaseItem):
+        return value.snapshot()
+    if isinstance(value, list):
+        return [_get_value_snapshot(v) for v in value]
+    return value
+
+
+def lazy_list(slot_name):
+    """
+    A list field which is stored in slot_name and created on the first access only.
+    """
+    def getter(self):
+        value = getattr(self, slot_name)
+        if value is None:
+            value = []
+            setattr(self, slot_name, value)
+        return value
+
+    def setter(self, value):
+        setattr(self, slot_name, value)
+
+    return property(getter, setter)
 
 
 class BaseItem(object):
+    # lazy list fields live in the slots starting with an underscore
+    __slots__ = ('xml_element',)
 
     def __init__(self, xml_element=None):
-        self.xml_element = xml_element
+        # the element pins its whole subtree, so it's kept only on demand
+        self.xml_element = xml_element if settings.CML_KEEP_XML_ELEMENTS else None
+
+    @classmethod
+    def get_slots(cls):
+        try:
+            return cls.__dict__['_all_slots']
+        except KeyError:
+            all_slots = tuple(slot for klass in reversed(cls.__mro__)
+                              for slot in klass.__dict__.get('__slots__', ()))
+            cls._all_slots = all_slots
+            return all_slots
+
+    def get_fields(self):
+        """
+        Yields (field name, value) pairs, lazy lists which were never accessed are empty tuples.
+        """
+        for slot in self.get_slots():
+            if slot == 'xml_element':
+                continue
+            value = getattr(self, slot)
+            if slot.startswith('_'):
+                yield slot[1:], () if value is None else value
+            else:
+                yield slot, value
+
+    def detach(self):
+        self.xml_element = None
+        for name, value in self.get_fields():
+            if isinstance(value, BaseItem):
+                value.detach()
+            elif isinstance(value, list):
+                for v in value:
+                    if isinstance(v, BaseItem):
+                        v.detach()
+
+    def snapshot(self):
+        """
+        Returns a copy of the item without its XML element, which can be kept
+        while the item itself is changed or reused.
+        """
+        item = self.__class__.__new__(self.__class__)
+        item.xml_element = None
+        for slot in self.get_slots():
+            if slot != 'xml_element':
+                setattr(item, slot, _get_value_snapshot(getattr(self, slot)))
+        return item
+
+    def get_reference_key(self):
+        """
+        The key of the item in ItemProcessor.references.
+        """
+        return self.id
+
+    def get_state(self):
+        return tuple((name, _get_value_state(value)) for name, value in sorted(self.get_fields()))
+
+    def get_fingerprint(self, *related_items):
+        state = (self.get_state(),) + tuple(item.get_state() for item in related_items)
+        return hashlib.sha1(repr(state).encode('utf-8')).hexdigest()
 
 
 class Group(BaseItem):
+    __slots__ = ('id', 'name', '_groups')
+
+    groups = lazy_list('_groups')
 
     def __init__(self, *args, **kwargs):
         super(Group, self).__init__(*args, **kwargs)
         self.id = u''
         self.name = u''
-        self.groups = []
+        self._groups = None
 
 
 class Property(BaseItem):
+    __slots__ = ('id', 'name', 'value_type', 'for_products')
 
     def __init__(self, *args, **kwargs):
         super(Property, self).__init__(*args, **kwargs)
@@ -32,6 +140,7 @@ class Property(BaseItem):
 
 
 class PropertyVariant(BaseItem):
+    __slots__ = ('id', 'value', 'property_id')
 
     def __init__(self, *args, **kwargs):
         super(PropertyVariant, self).__init__(*args, **kwargs)
@@ -39,8 +148,12 @@ class PropertyVariant(BaseItem):
         self.value = u''
         self.property_id = u''
 
+    def get_reference_key(self):
+        return self.property_id, self.id
+
 
 class Sku(BaseItem):
+    __slots__ = ('id', 'name', 'name_full', 'international_abbr')
 
     def __init__(self, *args, **kwargs):
         super(Sku, self).__init__(*args, **kwargs)
@@ -51,14 +164,19 @@ class Sku(BaseItem):
 
 
 class Tax(BaseItem):
+    __slots__ = ('name', 'value')
 
     def __init__(self, *args, **kwargs):
         super(Tax, self).__init__(*args, **kwargs)
         self.name = u''
         self.value = Decimal()
 
+    def get_reference_key(self):
+        return self.name
+
 
 class AdditionalField(BaseItem):
+    __slots__ = ('name', 'value')
 
     def __init__(self, *args, **kwargs):
         super(AdditionalField, self).__init__(*args, **kwargs)
@@ -67,20 +185,27 @@ class AdditionalField(BaseItem):
 
 
 class Product(BaseItem):
+    __slots__ = ('id', 'name', 'sku_id', '_group_ids', '_properties', 'tax_name', 'image_path',
+                 '_additional_fields')
+
+    group_ids = lazy_list('_group_ids')
+    properties = lazy_list('_properties')
+    additional_fields = lazy_list('_additional_fields')
 
     def __init__(self, *args, **kwargs):
         super(Product, self).__init__(*args, **kwargs)
         self.id = u''
         self.name = u''
         self.sku_id = u''
-        self.group_ids = []
-        self.properties = []
+        self._group_ids = None
+        self._properties = None
         self.tax_name = u''
         self.image_path = u''
-        self.additional_fields = []
+        self._additional_fields = None
 
 
 class PriceType(BaseItem):
+    __slots__ = ('id', 'name', 'currency', 'tax_name', 'tax_in_sum')
 
     def __init__(self, *args, **kwargs):
         super(PriceType, self).__init__(*args, **kwargs)
@@ -92,6 +217,7 @@ class PriceType(BaseItem):
 
 
 class Price(BaseItem):
+    __slots__ = ('representation', 'price_type_id', 'price_for_sku', 'currency_name', 'sku_name', 'sku_ratio')
 
     def __init__(self, *args, **kwargs):
         super(Price, self).__init__(*args, **kwargs)
@@ -104,18 +230,23 @@ class Price(BaseItem):
 
 
 class Offer(BaseItem):
+    __slots__ = ('id', 'name', 'sku_id', '_prices')
+
+    prices = lazy_list('_prices')
 
     def __init__(self, *args, **kwargs):
         super(Offer, self).__init__(*args, **kwargs)
         self.id = u''
         self.name = u''
         self.sku_id = u''
-        self.prices = []
+        self._prices = None
 
 
 class Client(BaseItem):
+    __slots__ = ('id', 'name', 'role', 'full_name', 'first_name', 'last_name', 'address')
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
         self.id = u''
         self.name = u''
         self.role = u'Покупатель'
@@ -126,8 +257,10 @@ class Client(BaseItem):
 
 
 class OrderItem(BaseItem):
+    __slots__ = ('id', 'name', 'sku', 'price', 'quant', 'sum')
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
+        super(OrderItem, self).__init__(*args, **kwargs)
         self.id = u''
         self.name = u''
         self.sku = Sku(None)
@@ -137,6 +270,11 @@ class OrderItem(BaseItem):
 
 
 class Order(BaseItem):
+    __slots__ = ('id', 'number', 'date', 'currency_name', 'currency_rate', 'operation', 'role', 'sum', 'client',
+                 'time', 'comment', '_items', '_additional_fields', 'updated_at')
+
+    items = lazy_list('_items')
+    additional_fields = lazy_list('_additional_fields')
 
     def __init__(self, *args, **kwargs):
         super(Order, self).__init__(*args, **kwargs)
@@ -151,5 +289,7 @@ class Order(BaseItem):
         self.client = Client()
         self.time = datetime.now().time()
         self.comment = u''
-        self.items = []
-        self.additional_fields = []
+        self._items = None
+        self._additional_fields = None
+        # the time of the last change, exports start after the last confirmed one
+        self.updated_at = None
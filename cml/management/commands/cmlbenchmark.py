@@ -0,0 +1,79 @@
+import os
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from cml.benchmarks import items, exchange, generator, pipelines
+
+DEFAULT_RESULTS_FILE_NAME = 'cml_benchmarks.jsonl'
+
+
+class Command(BaseCommand):
+    help = 'Runs the cml benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=['items', 'exchange', 'backends', 'resume'])
+        parser.add_argument('--count', type=int, default=200000, help='Number of items to build')
+        parser.add_argument('--source', help='Directory with a package to import, generated if not set')
+        parser.add_argument('--products', type=int, default=10000, help='Size of the generated package')
+        parser.add_argument('--orders', type=int, default=1000, help='Number of orders to import and export')
+        parser.add_argument('--writers', type=int, default=0, help='Value of CML_IMPORT_WRITERS')
+        parser.add_argument('--write-delay', type=float, default=0,
+                            help='Seconds the stand-in pipelines spend on every item')
+        parser.add_argument('--kill-after', type=int, default=10000,
+                            help='Number of items the resume benchmark kills the import after')
+        parser.add_argument('--results', default=DEFAULT_RESULTS_FILE_NAME, help='File to append the results to')
+
+    def handle(self, benchmark=None, count=None, **options):
+        if count < 1:
+            raise CommandError('Error: count must be positive')
+        if benchmark == 'items':
+            self.stdout.write('Bytes per offer with one price, {} offers:'.format(count))
+            for variant, size in items.run(count):
+                self.stdout.write('  {:<24}{:>8}'.format(variant, size))
+        elif benchmark == 'exchange':
+            self.run_exchange(options, exchange.run)
+        elif benchmark == 'backends':
+            self.stdout.write('XML backends: {}'.format(', '.join(exchange.get_backend_names())))
+            self.run_exchange(options, exchange.run_backends)
+        elif benchmark == 'resume':
+            if options['kill_after'] < 1:
+                raise CommandError('Error: kill-after must be positive')
+            self.run_exchange(options, lambda file_paths, orders, extra_settings: exchange.run_resume(
+                file_paths, options['kill_after'], extra_settings))
+
+    def run_exchange(self, options, run):
+        # the cases run in forked processes, they get the delay from here
+        pipelines.WRITE_DELAY = options['write_delay']
+        extra_settings = {'CML_IMPORT_WRITERS': options['writers']}
+        if options['source']:
+            file_names = [name for name in sorted(os.listdir(options['source'])) if name.endswith('.xml')]
+            file_paths = [os.path.join(options['source'], name) for name in file_names]
+            if not file_paths:
+                raise CommandError('Error: no XML files in "%s"' % options['source'])
+            results = run(file_paths, options['orders'], extra_settings)
+        else:
+            with tempfile.TemporaryDirectory() as dst:
+                package = generator.generate(dst, products=options['products'], orders=options['orders'])
+                file_paths = [package[name] for name in ('import.xml', 'offers.xml', 'orders.xml')]
+                results = run(file_paths, options['orders'], extra_settings)
+        self.report(results, exchange.load_results(options['results']))
+        exchange.save_results(options['results'], results)
+        self.stdout.write('Results appended to "%s".' % options['results'])
+
+    def report(self, results, last_results):
+        for result in results:
+            line = '{case}: {items} items in {seconds:.2f}s, {items_per_second:.0f} items/s, ' \
+                   'peak RSS {peak_rss_kb} KB'.format(**result)
+            last_result = last_results.get(result['case'])
+            if last_result and last_result['items_per_second']:
+                change = result['items_per_second'] / last_result['items_per_second'] * 100 - 100
+                line += ' ({:+.1f}% items/s)'.format(change)
+            if 'killed_after' in result:
+                if result['killed_after'] is None:
+                    line += ', the first run not killed, fewer items than --kill-after'
+                else:
+                    line += ', the first run killed after {} items'.format(result['killed_after'])
+            if not result['success']:
+                line += ' FAILED'
+            self.stdout.write(line)
+            for section, seconds in sorted(result['sections'].items()):
+                self.stdout.write('    {:<20}{:.2f}s'.format(section, seconds))
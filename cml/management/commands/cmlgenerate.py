@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from cml.benchmarks import generator
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic CommerceML 2.05 package (import.xml, offers.xml, orders.xml)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dst', help='Directory to write the package to')
+        parser.add_argument('--groups', type=int, default=100)
+        parser.add_argument('--properties', type=int, default=50)
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--offers', type=int, default=None, help='Defaults to the number of products')
+        parser.add_argument('--orders', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, dst=None, **options):
+        for name in ('groups', 'properties', 'products', 'orders'):
+            if options[name] < 0:
+                raise CommandError('Error: {} can\'t be negative'.format(name))
+        file_paths = generator.generate(dst, groups=options['groups'], properties=options['properties'],
+                                        products=options['products'], offers=options['offers'],
+                                        orders=options['orders'], seed=options['seed'])
+        for file_path in file_paths.values():
+            self.stdout.write('"%s" written.' % file_path)
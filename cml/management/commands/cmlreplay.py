@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from cml.conf import settings
+from cml.benchmarks import replay
+
+
+class Command(BaseCommand):
+    help = 'Replays the exchange sessions of a bundle recorded with CML_RECORD_ROOT against a server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('bundle', help='Directory of the replay bundle')
+        parser.add_argument('--url', default='http://127.0.0.1:8000/cml/exchange', help='URL of front_view')
+        parser.add_argument('--username', required=True)
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Sessions replayed at once, each with its own file names')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='The recorded pauses between the requests are divided by it, 0 for no pauses')
+        parser.add_argument('--repeat', type=int, default=1, help='Times every session is replayed')
+        parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for a response')
+
+    def handle(self, bundle=None, **options):
+        if options['concurrency'] < 1 or options['repeat'] < 1:
+            raise CommandError('Error: concurrency and repeat must be positive')
+        if options['speed'] < 0:
+            raise CommandError('Error: speed can\'t be negative')
+        try:
+            sessions = replay.load_sessions(bundle)
+        except (IOError, ValueError) as e:
+            raise CommandError('Error: can\'t load bundle "%s": %r' % (bundle, e))
+        client = replay.ReplayClient(bundle, options['url'], options['username'], options['password'],
+                                     speed=options['speed'], timeout=options['timeout'],
+                                     response_success=settings.CML_RESPONSE_SUCCESS,
+                                     response_progress=settings.CML_RESPONSE_PROGRESS,
+                                     response_error=settings.CML_RESPONSE_ERROR)
+        self.stdout.write('Replaying {} sessions x{} at concurrency {}...'.format(
+            len(sessions), options['repeat'], options['concurrency']))
+        try:
+            results = client.replay(sessions * options['repeat'], options['concurrency'])
+        except ValueError as e:
+            raise CommandError('Error: %s' % e)
+        self.stdout.write('{:<20}{:>9}{:>9}{}{:>9}'.format(
+            'route', 'requests', 'failed', ''.join('{:>9}'.format('p{}'.format(percent))
+                                                    for percent in replay.PERCENTILES), 'max'))
+        for route, requests, failures, percentiles, max_seconds in replay.summarize(results):
+            self.stdout.write('{:<20}{:>9}{:>9}{}{:>9.3f}'.format(
+                '/'.join(route), requests, failures,
+                ''.join('{:>9.3f}'.format(seconds) for seconds in percentiles.values()), max_seconds))
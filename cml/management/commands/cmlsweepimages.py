@@ -0,0 +1,20 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from cml.utils import ImageStore, ItemProcessor
+
+
+class Command(BaseCommand):
+    help = 'Removes the stored product images no product refers to and no import used for the given number of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+
+    def handle(self, days=None, **options):
+        if days < 1:
+            raise CommandError('Error: days must be positive')
+        image_paths = ItemProcessor(item_class_names=('Product',)).get_image_paths()
+        if image_paths is None:
+            raise CommandError('Error: ProductPipeline has no get_image_paths(), '
+                               'the images products refer to are unknown')
+        removed, removed_size = ImageStore().sweep(timedelta(days=days), image_paths)
+        self.stdout.write('{} images removed, {} bytes freed.'.format(removed, removed_size))
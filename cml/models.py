@@ -1,6 +1,8 @@
 from __future__ import absolute_import
+from datetime import timedelta
 from django.db import models
-from django.conf import settings
+from django.utils import timezone
+from .conf import settings
 
 
 class Exchange(models.Model):
@@ -18,8 +20,294 @@ class Exchange(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     filename = models.CharField(max_length=200)
+    session_key = models.CharField(max_length=100, blank=True)
+    # failed imports are logged too, with the metrics up to the failure
+    is_success = models.BooleanField(default=True)
+    # an export is confirmed by sale/success, its watermark is where the next one starts
+    is_confirmed = models.BooleanField(default=True)
+    watermark = models.DateTimeField(null=True, blank=True)
+    watermark_id = models.CharField(max_length=200, blank=True)
+    exported_ids = models.TextField(blank=True)
 
     @classmethod
-    def log(cls, exchange_type, user, filename=u''):
-        ex_log = Exchange(exchange_type=exchange_type, user=user, filename=filename)
+    def log(cls, exchange_type, user, filename=u'', **kwargs):
+        ex_log = Exchange(exchange_type=exchange_type, user=user, filename=filename, **kwargs)
         ex_log.save()
+        return ex_log
+
+    @classmethod
+    def get_export_watermark(cls):
+        """
+        Returns (updated_at, id) of the last order 1C confirmed to get, or None.
+        """
+        ex_log = cls.objects.filter(exchange_type='export', is_confirmed=True,
+                                    watermark__isnull=False).order_by('-pk').first()
+        if ex_log is None:
+            return None
+        return ex_log.watermark, ex_log.watermark_id
+
+    @classmethod
+    def get_pending_export(cls, user, session_key):
+        """
+        Returns the last unconfirmed export of the session locked for update, call within a transaction.
+        """
+        return cls.objects.select_for_update().filter(exchange_type='export', is_confirmed=False, user=user,
+                                                      session_key=session_key).order_by('-pk').first()
+
+    def get_exported_ids(self):
+        return [exported_id for exported_id in self.exported_ids.split(u'\n') if exported_id]
+
+
+class ItemFingerprint(models.Model):
+
+    class Meta:
+        verbose_name = 'Item fingerprint'
+        verbose_name_plural = 'Item fingerprints'
+        unique_together = ('item_type', 'item_id')
+
+    item_type = models.CharField(max_length=50)
+    item_id = models.CharField(max_length=200)
+    fingerprint = models.CharField(max_length=40)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ImportCheckpoint(models.Model):
+
+    class Meta:
+        verbose_name = 'Import checkpoint'
+        verbose_name_plural = 'Import checkpoints'
+
+    file_key = models.CharField(max_length=500, unique=True)
+    # a checkpoint of another version of the file is reset
+    signature = models.CharField(max_length=100)
+    section = models.CharField(max_length=100, blank=True)
+    # the number of handled elements of the file stored before the checkpoint
+    handled = models.PositiveIntegerField(default=0)
+    last_id = models.CharField(max_length=200, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def reset(self, signature):
+        self.signature = signature
+        self.section = u''
+        self.handled = 0
+        self.last_id = u''
+        self.save()
+
+
+class StoredImage(models.Model):
+
+    class Meta:
+        verbose_name = 'Stored image'
+        verbose_name_plural = 'Stored images'
+
+    filename = models.CharField(max_length=200, unique=True)
+    content_hash = models.CharField(max_length=40, db_index=True)
+    # the last import of a product with the image, stale images are swept
+    last_used = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ExchangeLock(models.Model):
+
+    class Meta:
+        verbose_name = 'Exchange lock'
+        verbose_name_plural = 'Exchange locks'
+
+    # an import lock or a slot of a lane, see cml.scheduler
+    name = models.CharField(max_length=200, unique=True)
+    # the holder, the lock of a crashed one is taken over once it expires
+    token = models.CharField(max_length=32)
+    expires = models.DateTimeField(db_index=True)
+
+
+class ExchangeToken(models.Model):
+
+    class Meta:
+        verbose_name = 'Exchange token'
+        verbose_name_plural = 'Exchange tokens'
+
+    # the sha256 of the token checkauth gave 1C, see cml.auth
+    key = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    expires = models.DateTimeField(db_index=True)
+
+
+class UploadedFile(models.Model):
+
+    class Meta:
+        verbose_name = 'Uploaded file'
+        verbose_name_plural = 'Uploaded files'
+        unique_together = ('session_key', 'filename')
+
+    # the files an exchange session uploaded, its first import takes them as a package
+    session_key = models.CharField(max_length=100)
+    filename = models.CharField(max_length=200)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_filenames(cls, session_key):
+        return list(cls.objects.filter(session_key=session_key).values_list('filename', flat=True))
+
+
+class ImportTask(models.Model):
+
+    class Meta:
+        verbose_name = 'Import task'
+        verbose_name_plural = 'Import tasks'
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCESS = 'success'
+    STATUS_FAILURE = 'failure'
+
+    status_choices = {
+        (STATUS_PENDING, 'pending'),
+        (STATUS_RUNNING, 'running'),
+        (STATUS_SUCCESS, 'success'),
+        (STATUS_FAILURE, 'failure'),
+    }
+
+    filename = models.CharField(max_length=200)
+    file_path = models.CharField(max_length=500)
+    archive_path = models.CharField(max_length=500, blank=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # the exchange session, its files are imported as one package
+    session_key = models.CharField(max_length=100, blank=True)
+    # the exchange whose init marks the task reported, 'catalog' or 'sale'
+    exchange_type = models.CharField(max_length=50, blank=True)
+    status = models.CharField(max_length=50, choices=status_choices, default=STATUS_PENDING)
+    progress = models.PositiveSmallIntegerField(default=0)
+    message = models.TextField(blank=True)
+    is_reported = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCESS, self.STATUS_FAILURE)
+
+    @classmethod
+    def get_unreported(cls, filename):
+        return cls.objects.filter(filename=filename, is_reported=False).order_by('-pk').first()
+
+    def set_status(self, status, message=u''):
+        self.status = status
+        self.message = message
+        if status == self.STATUS_SUCCESS:
+            self.progress = 100
+        self.save(update_fields=['status', 'message', 'progress', 'updated'])
+
+    def set_progress(self, progress):
+        self.progress = progress
+        self.updated = timezone.now()
+        ImportTask.objects.filter(pk=self.pk).update(progress=progress, updated=self.updated)
+
+    def get_stale_tasks(self):
+        """
+        Returns the unfinished tasks of the package of the task if its worker is gone, or [].
+        A running package refreshes its tasks, they go stale after CML_IMPORT_LOCK_TIMEOUT.
+        """
+        if self.is_finished:
+            return []
+        stale_tasks = ImportTask.objects.filter(
+            is_reported=False, status__in=(self.STATUS_PENDING, self.STATUS_RUNNING),
+            updated__lt=timezone.now() - timedelta(seconds=settings.CML_IMPORT_LOCK_TIMEOUT))
+        if self.session_key:
+            stale_tasks = list(stale_tasks.filter(session_key=self.session_key))
+        else:
+            stale_tasks = list(stale_tasks.filter(pk=self.pk))
+        if not any(stale_task.status == self.STATUS_RUNNING for stale_task in stale_tasks):
+            # pending ones may be queued behind other imports
+            return []
+        if self not in stale_tasks:
+            stale_tasks.append(self)
+        return stale_tasks
+
+
+class ExchangeMetrics(models.Model):
+
+    class Meta:
+        verbose_name = 'Exchange metrics'
+        verbose_name_plural = 'Exchange metrics'
+
+    TREND_WINDOW = 10
+
+    exchange = models.OneToOneField(Exchange, on_delete=models.CASCADE, related_name='metrics')
+    seconds = models.FloatField(default=0)
+    items = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    # peak RSS of the process in kilobytes during the exchange, shared by the exchanges a process
+    # runs at once; where the peak can't be reset (not Linux) it's the peak of all it ran
+    peak_memory = models.PositiveIntegerField(default=0)
+    # {section tag: seconds} of the file sections, the time of the pipelines is included
+    section_seconds = models.JSONField(default=dict, blank=True)
+    # {item type: seconds} spent in the pipelines
+    pipeline_seconds = models.JSONField(default=dict, blank=True)
+    item_counts = models.JSONField(default=dict, blank=True)
+    error_counts = models.JSONField(default=dict, blank=True)
+    # related items an import didn't pass to the pipelines again, by item type
+    duplicate_counts = models.JSONField(default=dict, blank=True)
+    # the transaction chunks of CML_TRANSACTION_CHUNK_SIZE items: how many were committed,
+    # how long their commits took and how long they were open, so held their locks
+    commits = models.PositiveIntegerField(default=0)
+    commit_seconds = models.FloatField(default=0)
+    max_commit_seconds = models.FloatField(default=0)
+    lock_seconds = models.FloatField(default=0)
+    max_lock_seconds = models.FloatField(default=0)
+
+    @classmethod
+    def record(cls, ex_log, metrics):
+        return cls.objects.create(exchange=ex_log, **metrics)
+
+    @property
+    def items_per_second(self):
+        return self.items / self.seconds if self.seconds else 0
+
+    def get_trend(self):
+        """
+        Returns the throughput relative to the mean of the previous successful
+        exchanges of the same type and file, e.g. 0.8 if it's 20% slower, or None.
+        """
+        return self.get_trends([self]).get(self.pk)
+
+    @classmethod
+    def get_trends(cls, metrics_list):
+        """
+        Returns {pk: get_trend()} of the metrics with their exchanges, in one query.
+        """
+        by_key = {}
+        for metrics in metrics_list:
+            by_key.setdefault((metrics.exchange.exchange_type, metrics.exchange.filename), []).append(metrics)
+        if not by_key:
+            return {}
+        # (pk, items per second) of the previous exchanges by key, the latest first
+        previous = dict((key, []) for key in by_key)
+        # the keys whose earliest metrics don't have their window yet, with its pk
+        missing = dict((key, min(metrics.pk for metrics in key_metrics)) for key, key_metrics in by_key.items())
+        windows = dict((key, 0) for key in by_key)
+        rows = cls.objects.filter(exchange__exchange_type__in=set(key[0] for key in by_key),
+                                  exchange__filename__in=set(key[1] for key in by_key),
+                                  exchange__is_success=True, seconds__gt=0,
+                                  pk__lt=max(metrics.pk for metrics in metrics_list))
+        rows = rows.order_by('-pk').values_list('pk', 'exchange__exchange_type', 'exchange__filename',
+                                                'items', 'seconds')
+        for pk, exchange_type, filename, items, seconds in rows.iterator():
+            key = (exchange_type, filename)
+            if key not in missing:
+                continue
+            previous[key].append((pk, items / seconds))
+            if pk < missing[key]:
+                windows[key] += 1
+                if windows[key] >= cls.TREND_WINDOW:
+                    # so have the later metrics of the key
+                    del missing[key]
+                    if not missing:
+                        break
+        trends = {}
+        for key, key_metrics in by_key.items():
+            for metrics in key_metrics:
+                rates = [rate for pk, rate in previous[key] if pk < metrics.pk][:cls.TREND_WINDOW]
+                if rates and sum(rates):
+                    trends[metrics.pk] = metrics.items_per_second / (sum(rates) / len(rates))
+        return trends
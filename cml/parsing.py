@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -
+"""
+Dispatch tables of the child elements of the CommerceML items. Each item element is
+walked once and every child goes to the handler of its tag, instead of looking up
+every field with element.find().
+"""
+from __future__ import absolute_import
+import os
+from decimal import Decimal
+from .items import *
+from .conf import settings
+
+
+def parse_children(import_manager, element, item, handlers, related_items=None):
+    """
+    Walks the children of the element once and dispatches each of them by its tag.
+    A handler is either the name of the item field to store the stripped text of
+    the child in or handler(import_manager, child_element, item, related_items).
+    """
+    for child_element in element:
+        handler = handlers.get(child_element.tag)
+        if handler is None:
+            continue
+        if handler.__class__ is str:
+            text = child_element.text
+            setattr(item, handler, text.strip(u' ') if text else u'')
+        else:
+            handler(import_manager, child_element, item, related_items)
+
+
+def flag_field(field_name):
+    def handler(import_manager, element, item, related_items):
+        text = element.text
+        setattr(item, field_name, text is not None and text.strip(u' ') == u'true')
+    return handler
+
+
+def decimal_field(field_name):
+    def handler(import_manager, element, item, related_items):
+        text = element.text
+        setattr(item, field_name, Decimal(text.strip(u' ') if text else u''))
+    return handler
+
+
+def nested_fields(handlers):
+    """
+    Fills the item from the children of a wrapping element, e.g. Налог of ТипЦены.
+    """
+    def handler(import_manager, element, item, related_items):
+        parse_children(import_manager, element, item, handlers, related_items)
+    return handler
+
+
+def item_list(field_name, tag, item_class, handlers):
+    """
+    Appends an item_class item to item.field_name for every tag child of the element.
+    """
+    def handler(import_manager, element, item, related_items):
+        items = getattr(item, field_name)
+        for child_element in element:
+            if child_element.tag == tag:
+                child_item = item_class(child_element)
+                parse_children(import_manager, child_element, child_item, handlers)
+                items.append(child_item)
+    return handler
+
+
+def _fill_sku(sku_item, sku_element):
+    text = sku_element.text
+    sku_item.id = sku_element.get(u'Код')
+    sku_item.name_full = sku_element.get(u'НаименованиеПолное')
+    sku_item.international_abbr = sku_element.get(u'МеждународноеСокращение')
+    sku_item.name = text.strip(u' ') if text else u''
+
+
+def _parse_sku(import_manager, sku_element, item, related_items):
+    sku_item = Sku(sku_element)
+    _fill_sku(sku_item, sku_element)
+    item.sku_id = sku_item.id
+    related_items.append(sku_item)
+
+
+def _parse_order_item_sku(import_manager, sku_element, order_item, related_items):
+    _fill_sku(order_item.sku, sku_element)
+
+
+def _parse_subgroups(import_manager, groups_element, group_item, related_items):
+    for group_element in groups_element:
+        if group_element.tag == u'Группа':
+            import_manager._parse_group(group_element, group_item)
+
+
+def _parse_property_variants(import_manager, variants_element, property_item, related_items):
+    # the variants are filtered by ТипЗначений once the whole property is parsed
+    for variant_element in variants_element:
+        variant = PropertyVariant(variant_element)
+        parse_children(import_manager, variant_element, variant, PROPERTY_VARIANT_HANDLERS)
+        related_items.append((variant_element.tag, variant))
+
+
+def _parse_image(import_manager, image_element, product_item, related_items):
+    # the first picture is the main one
+    if product_item.image_path:
+        return
+    text = image_element.text
+    image_filename = os.path.basename(text.strip(u' ')) if text else u''
+    if image_filename:
+        product_item.image_path = os.path.join(settings.CML_UPLOAD_ROOT, image_filename)
+
+
+def _parse_group_ids(import_manager, groups_element, product_item, related_items):
+    for group_id_element in groups_element:
+        if group_id_element.tag == u'Ид':
+            text = group_id_element.text
+            product_item.group_ids.append(text.strip(u' ') if text else u'')
+
+
+def _parse_property_values(import_manager, properties_element, product_item, related_items):
+    for property_element in properties_element:
+        if property_element.tag != u'ЗначенияСвойства':
+            continue
+        property_id = property_variant_id = u''
+        for child_element in property_element:
+            if child_element.tag == u'Ид' and child_element.text:
+                property_id = child_element.text.strip(u' ')
+            elif child_element.tag == u'Значение' and child_element.text:
+                property_variant_id = child_element.text.strip(u' ')
+        if property_variant_id:
+            product_item.properties.append((property_id, property_variant_id))
+
+
+def _parse_taxes(import_manager, taxes_element, product_item, related_items):
+    for tax_element in taxes_element:
+        if tax_element.tag != u'СтавкаНалога':
+            continue
+        tax_item = Tax(tax_element)
+        parse_children(import_manager, tax_element, tax_item, TAX_HANDLERS)
+        related_items.append(tax_item)
+        product_item.tax_name = tax_item.name
+
+
+def _parse_tax_value(import_manager, value_element, tax_item, related_items):
+    try:
+        tax_item.value = Decimal(value_element.text.strip(u' '))
+    except Exception:
+        tax_item.value = Decimal()
+
+
+def _parse_client(import_manager, clients_element, order_item, related_items):
+    client_element = clients_element.find(u'Контрагент')
+    if client_element is not None:
+        parse_children(import_manager, client_element, order_item.client, CLIENT_HANDLERS)
+
+
+ADDITIONAL_FIELD_HANDLERS = {
+    u'Наименование': 'name',
+    u'Значение': 'value',
+}
+
+GROUP_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'Группы': _parse_subgroups,
+}
+
+PROPERTY_VARIANT_HANDLERS = {
+    u'ИдЗначения': 'id',
+    u'Значение': 'value',
+}
+
+PROPERTY_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'ТипЗначений': 'value_type',
+    u'ДляТоваров': flag_field('for_products'),
+    u'ВариантыЗначений': _parse_property_variants,
+}
+
+TAX_HANDLERS = {
+    u'Наименование': 'name',
+    u'Ставка': _parse_tax_value,
+}
+
+PRODUCT_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'БазоваяЕдиница': _parse_sku,
+    u'Картинка': _parse_image,
+    u'Группы': _parse_group_ids,
+    u'ЗначенияСвойств': _parse_property_values,
+    u'СтавкиНалогов': _parse_taxes,
+    u'ЗначенияРеквизитов': item_list('additional_fields', u'ЗначениеРеквизита', AdditionalField,
+                                     ADDITIONAL_FIELD_HANDLERS),
+}
+
+PRICE_TYPE_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'Валюта': 'currency',
+    u'Налог': nested_fields({
+        u'Наименование': 'tax_name',
+        u'УчтеноВСумме': flag_field('tax_in_sum'),
+    }),
+}
+
+PRICE_HANDLERS = {
+    u'Представление': 'representation',
+    u'ИдТипаЦены': 'price_type_id',
+    u'ЦенаЗаЕдиницу': decimal_field('price_for_sku'),
+    u'Валюта': 'currency_name',
+    u'Единица': 'sku_name',
+    u'Коэффициент': decimal_field('sku_ratio'),
+}
+
+OFFER_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'БазоваяЕдиница': _parse_sku,
+    u'Цены': item_list('prices', u'Цена', Price, PRICE_HANDLERS),
+}
+
+CLIENT_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'ПолноеНаименование': 'full_name',
+}
+
+ORDER_ITEM_HANDLERS = {
+    u'Ид': 'id',
+    u'Наименование': 'name',
+    u'БазоваяЕдиница': _parse_order_item_sku,
+    u'ЦенаЗаЕдиницу': 'price',
+    u'Количество': 'quant',
+    u'Сумма': 'sum',
+}
+
+ORDER_HANDLERS = {
+    u'Ид': 'id',
+    u'Номер': 'number',
+    u'Дата': 'date',
+    u'Валюта': 'currency_name',
+    u'Курс': 'currency_rate',
+    u'ХозОперация': 'operation',
+    u'Роль': 'role',
+    u'Сумма': 'sum',
+    u'Время': 'time',
+    u'Комментарий': 'comment',
+    u'Контрагенты': _parse_client,
+    u'Товары': item_list('items', u'Товар', OrderItem, ORDER_ITEM_HANDLERS),
+    u'ЗначенияРеквизитов': item_list('additional_fields', u'ЗначениеРеквизита', AdditionalField,
+                                     ADDITIONAL_FIELD_HANDLERS),
+}
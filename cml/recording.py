@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -
+"""
+Records the exchange requests front_view gets into a replay bundle, see the
+cmlreplay command. A bundle is a directory with requests.jsonl, a request per
+line in the order they came, and the request bodies under bodies/.
+"""
+from __future__ import absolute_import
+import io
+import os
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+REQUESTS_FILE_NAME = 'requests.jsonl'
+BODIES_DIR_NAME = 'bodies'
+
+
+class ExchangeRecorder(object):
+    """
+    Appends the requests to the bundle in bundle_dir, several processes may share it.
+    """
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        self.bodies_dir = os.path.join(bundle_dir, BODIES_DIR_NAME)
+        self._lock = threading.Lock()
+        if not os.path.exists(self.bodies_dir):
+            os.makedirs(self.bodies_dir, exist_ok=True)
+
+    def record(self, request, body, response, session_key, started, seconds):
+        body_name = None
+        if body:
+            body_name = u'{}.bin'.format(uuid.uuid4().hex)
+            with open(os.path.join(self.bodies_dir, body_name), 'wb') as f:
+                f.write(body)
+        content = b'' if response.streaming else response.content
+        record = {
+            'started': started,
+            'seconds': seconds,
+            # the session key is a token, keep only its hash
+            'session': hashlib.sha1(session_key.encode('utf-8')).hexdigest() if session_key else u'',
+            'method': request.method,
+            'params': OrderedDict(request.GET.items()),
+            'body': body_name,
+            'status_code': response.status_code,
+            'result': content.split(b'\n', 1)[0].decode('utf-8', 'replace'),
+        }
+        line = json.dumps(record, ensure_ascii=False) + u'\n'
+        with self._lock:
+            with io.open(os.path.join(self.bundle_dir, REQUESTS_FILE_NAME), 'a', encoding='utf-8') as f:
+                f.write(line)
@@ -0,0 +1,114 @@
+"""
+Priority lanes of the exchange requests and the import locks. The slots of the
+lanes and the locks are rows of ExchangeLock, so they work across the processes
+of all the servers sharing the database.
+"""
+from __future__ import absolute_import
+import uuid
+import logging
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import ExchangeLock
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+SALE_LANE = 'sale'
+CATALOG_LANE = 'catalog'
+
+# orders go ahead of the catalogue, the rest of the routes are quick and go as they come
+LANE_ROUTES = {
+    (u'sale', u'file'): SALE_LANE,
+    (u'sale', u'query'): SALE_LANE,
+    (u'sale', u'success'): SALE_LANE,
+    (u'import', u'import'): SALE_LANE,
+    (u'catalog', u'import'): CATALOG_LANE,
+}
+
+LANE_LOCK_PREFIX = 'lane:'
+
+
+def get_lane(view_key):
+    return LANE_ROUTES.get(view_key)
+
+
+def _get_lane_prefix(lane):
+    return u'{}{}:'.format(LANE_LOCK_PREFIX, lane)
+
+
+def acquire_lane_slot(lane):
+    """
+    Takes one of the CML_LANE_LIMITS[lane] slots of the lane, or a slot of its own if
+    the lane has no limit. Returns (name, token) of the slot or None if all are taken.
+    """
+    limit = settings.CML_LANE_LIMITS.get(lane, 0)
+    prefix = _get_lane_prefix(lane)
+    # the slots of crashed processes
+    ExchangeLock.objects.filter(name__startswith=prefix, expires__lt=timezone.now()).delete()
+    if not limit:
+        name = prefix + uuid.uuid4().hex
+        return name, acquire_lock(name, settings.CML_LANE_SLOT_TIMEOUT)
+    for index in range(limit):
+        name = u'{}{}'.format(prefix, index)
+        token = acquire_lock(name, settings.CML_LANE_SLOT_TIMEOUT)
+        if token is not None:
+            return name, token
+    return None
+
+
+def release_lane_slot(lane, slot):
+    release_lock(*slot)
+
+
+def is_lane_busy(lane):
+    return ExchangeLock.objects.filter(name__startswith=_get_lane_prefix(lane), expires__gt=timezone.now()).exists()
+
+
+def release_lane_slot_after(response, lane, slot):
+    """
+    Releases the slot once the response is sent, a streamed one holds it until the end.
+    """
+    if not response.streaming:
+        release_lane_slot(lane, slot)
+        return response
+    response.streaming_content = _release_when_streamed(response.streaming_content, lane, slot)
+    return response
+
+
+def _release_when_streamed(streaming_content, lane, slot):
+    try:
+        for chunk in streaming_content:
+            yield chunk
+    finally:
+        release_lane_slot(lane, slot)
+
+
+def acquire_lock(name, timeout=None):
+    """
+    Returns the token of the lock if it was free and is taken now, otherwise None.
+    It's released by release_lock() or after the timeout (CML_IMPORT_LOCK_TIMEOUT)
+    since it was last refreshed.
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    expires = now + timedelta(seconds=settings.CML_IMPORT_LOCK_TIMEOUT if timeout is None else timeout)
+    try:
+        with transaction.atomic():
+            ExchangeLock.objects.create(name=name, token=token, expires=expires)
+        return token
+    except IntegrityError:
+        pass
+    # the lock of a crashed process is taken over
+    if ExchangeLock.objects.filter(name=name, expires__lt=now).update(token=token, expires=expires):
+        return token
+    return None
+
+
+def refresh_lock(name, token, timeout=None):
+    expires = timezone.now() + timedelta(seconds=settings.CML_IMPORT_LOCK_TIMEOUT if timeout is None else timeout)
+    ExchangeLock.objects.filter(name=name, token=token).update(expires=expires)
+
+
+def release_lock(name, token):
+    ExchangeLock.objects.filter(name=name, token=token).delete()
@@ -0,0 +1,270 @@
+from __future__ import absolute_import
+import os
+import time
+import logging
+import threading
+from functools import partial
+from celery import shared_task
+from django.db import connection, transaction
+from django.utils import timezone
+from .utils import ImportPackage
+from .models import Exchange, ExchangeMetrics, ImportTask
+from .scheduler import acquire_lock, refresh_lock, release_lock
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1
+
+
+@shared_task
+def import_package_task(import_task_ids, lane_slot=None):
+    run_package(import_task_ids, lane_slot)
+
+
+def run_package(import_task_ids, lane_slot=None):
+    """
+    Imports the files of the tasks classifier first, then catalogue, offers and documents.
+    A failed file fails the rest of the package, they may reference its items.
+    The package fails if one of its files is being imported by another task.
+    The (name, token) lane_slot of the request that started the package is held
+    until the package is done, so a lane runs no more imports than it has slots.
+    """
+    import_tasks = list(ImportTask.objects.filter(pk__in=import_task_ids))
+    if len(import_tasks) != len(set(import_task_ids)):
+        logger.error('Import tasks {} not found!'.format(
+            sorted(set(import_task_ids) - set(import_task.pk for import_task in import_tasks))))
+    import_tasks.sort(key=lambda import_task: ImportPackage.get_file_rank(import_task.file_path,
+                                                                          import_task.archive_path or None))
+    started = time.time()
+    # the lane slot is refreshed and released along with the import locks
+    locks = [tuple(lane_slot)] if lane_slot else []
+    for import_task in import_tasks:
+        lock_name = u'import:{}'.format(import_task.filename)
+        lock_token = acquire_lock(lock_name)
+        if lock_token is None:
+            for lock in locks:
+                release_lock(*lock)
+            _fail_tasks(import_tasks, 'Not imported, {} is being imported already'.format(import_task.filename))
+            return
+        locks.append((lock_name, lock_token))
+    # sqlite has one writer at a time, the writes of another connection would wait for an atomic package
+    heartbeat = PackageHeartbeat(import_tasks, locks, writes=not (
+        settings.CML_ATOMIC_PACKAGES and connection.vendor == 'sqlite'))
+    heartbeat.start()
+    try:
+        _run_locked_package(import_tasks, heartbeat)
+    finally:
+        heartbeat.stop()
+        for lock in locks:
+            release_lock(*lock)
+    if settings.CML_DELETE_FILES_AFTER_IMPORT:
+        for archive_path in set(import_task.archive_path for import_task in import_tasks if import_task.archive_path):
+            _remove_unused_archive(archive_path, started)
+
+
+def _run_locked_package(import_tasks, heartbeat):
+    package = ImportPackage()
+    if settings.CML_ATOMIC_PACKAGES:
+        _run_atomic_package(package, import_tasks, heartbeat)
+        return
+    for index, import_task in enumerate(import_tasks):
+        import_task.set_status(ImportTask.STATUS_RUNNING)
+        import_manager = _get_import_manager(package, import_task, _write_progress)
+        try:
+            import_manager.import_all()
+        except Exception as e:
+            # the checkpoint stays, the next import of the file continues from it
+            logger.error('Import task {} error: {}'.format(import_task.pk, repr(e)))
+            import_task.set_status(ImportTask.STATUS_FAILURE, repr(e))
+            _log_failure(import_task, import_manager)
+            _fail_tasks(import_tasks[index + 1:], 'Not imported after {} failed'.format(import_task.filename))
+            return
+        _finish_import(import_task, import_manager.get_metrics())
+
+
+def _run_atomic_package(package, import_tasks, heartbeat):
+    for import_task in import_tasks:
+        import_task.set_status(ImportTask.STATUS_RUNNING)
+    # the processor is shared, so the metrics of each file are taken as soon as it's done
+    metrics = []
+    import_manager = None
+    try:
+        with transaction.atomic():
+            for import_task in import_tasks:
+                import_manager = None
+                # the writes of the package aren't seen until it's committed, not even the progress
+                import_manager = _get_import_manager(package, import_task, heartbeat.set_progress)
+                import_manager.import_all()
+                metrics.append(import_manager.get_metrics())
+    except Exception as e:
+        if len(metrics) == len(import_tasks):
+            # every file was imported, the commit failed
+            logger.error('Import package commit error: {}'.format(repr(e)))
+            _fail_tasks(import_tasks, 'Package not committed: {}'.format(repr(e)))
+        else:
+            failed_task = import_tasks[len(metrics)]
+            logger.error('Import task {} error, package rolled back: {}'.format(failed_task.pk, repr(e)))
+            failed_task.set_status(ImportTask.STATUS_FAILURE, repr(e))
+            _fail_tasks([import_task for import_task in import_tasks if import_task is not failed_task],
+                        'Rolled back after {} failed'.format(failed_task.filename))
+            _log_failure(failed_task, import_manager)
+        # the files imported before were rolled back
+        for import_task, import_metrics in zip(import_tasks, metrics):
+            _log_import(import_task, import_metrics, is_success=False)
+        return
+    for import_task, import_metrics in zip(import_tasks, metrics):
+        _finish_import(import_task, import_metrics)
+
+
+def _write_progress(import_task, progress):
+    import_task.set_progress(progress)
+
+
+def _get_import_manager(package, import_task, write_progress):
+    import_manager = package.get_import_manager(import_task.file_path, import_task.archive_path or None)
+    import_manager.progress_callback = partial(write_progress, import_task)
+    return import_manager
+
+
+def _finish_import(import_task, metrics):
+    if settings.CML_DELETE_FILES_AFTER_IMPORT and not import_task.archive_path:
+        try:
+            os.remove(import_task.file_path)
+        except OSError:
+            logger.error('Can\'t delete file after import: {}'.format(import_task.file_path))
+    _log_import(import_task, metrics)
+    import_task.set_status(ImportTask.STATUS_SUCCESS)
+
+
+def _log_import(import_task, metrics, is_success=True):
+    ex_log = Exchange.log('import', import_task.user, import_task.filename,
+                          session_key=import_task.session_key, is_success=is_success)
+    ExchangeMetrics.record(ex_log, metrics)
+
+
+def _log_failure(import_task, import_manager):
+    # the metrics up to the failure, the task has failed already if they can't be had
+    try:
+        _log_import(import_task, import_manager.get_metrics() if import_manager is not None else {},
+                    is_success=False)
+    except Exception as e:
+        logger.error('Can\'t log failed import task {}: {}'.format(import_task.pk, repr(e)))
+
+
+def _remove_unused_archive(archive_path, started):
+    # the archive goes after the last task reading it, unless it was uploaded again meanwhile
+    if not os.path.exists(archive_path) or ImportTask.objects.filter(archive_path=archive_path,
+                                 status__in=(ImportTask.STATUS_PENDING, ImportTask.STATUS_RUNNING)).exists():
+        return
+    try:
+        if os.path.getmtime(archive_path) < started:
+            os.remove(archive_path)
+    except OSError:
+        logger.error('Can\'t delete zip package after import: {}'.format(archive_path))
+
+
+def _fail_tasks(import_tasks, message):
+    for import_task in import_tasks:
+        import_task.set_status(ImportTask.STATUS_FAILURE, message)
+
+
+def start_package(import_tasks, lane=None, lane_slot=None):
+    import_task_ids = [import_task.pk for import_task in import_tasks]
+    queue = settings.CML_LANE_QUEUES.get(lane)
+    try:
+        import_package_task.apply_async((import_task_ids, lane_slot), **({'queue': queue} if queue else {}))
+    except Exception as e:
+        # no broker available, keep the import out of the request anyway
+        logger.error('Can\'t queue import task, running it in a thread: {}'.format(repr(e)))
+        thread = threading.Thread(target=_run_package_in_thread, args=(import_task_ids, lane_slot))
+        thread.daemon = True
+        thread.start()
+
+
+def _run_package_in_thread(import_task_ids, lane_slot=None):
+    try:
+        run_package(import_task_ids, lane_slot)
+    finally:
+        connection.close()
+
+
+class PackageHeartbeat(threading.Thread):
+    """
+    Refreshes the locks and the unfinished tasks of a running package every third of
+    CML_IMPORT_LOCK_TIMEOUT with a connection of its own, the tasks of a package that
+    wasn't refreshed for longer are taken for the ones of a dead worker and imported again.
+    set_progress() writes the progress of a task the same way, only the latest one
+    if it's changing faster than the writes go.
+    """
+
+    def __init__(self, import_tasks, locks, writes=True):
+        super(PackageHeartbeat, self).__init__()
+        self.daemon = True
+        self.import_task_ids = [import_task.pk for import_task in import_tasks]
+        self.locks = locks
+        self.writes = writes
+        self.interval = settings.CML_IMPORT_LOCK_TIMEOUT / 3.0
+        self._progress = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def set_progress(self, import_task, progress):
+        import_task.progress = progress
+        if not self.writes:
+            return
+        with self._lock:
+            self._progress[import_task.pk] = progress
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        self.join()
+
+    def run(self):
+        try:
+            beaten = time.time()
+            while True:
+                self._wake.wait(max(beaten + self.interval - time.time(), 0))
+                self._wake.clear()
+                stopped = self._stopped
+                with self._lock:
+                    progress, self._progress = self._progress, {}
+                try:
+                    for import_task_id, task_progress in progress.items():
+                        ImportTask.objects.filter(pk=import_task_id).update(progress=task_progress,
+                                                                            updated=timezone.now())
+                    if time.time() >= beaten + self.interval:
+                        self.beat()
+                        beaten = time.time()
+                except Exception as e:
+                    logger.error('Import package heartbeat error: {}'.format(repr(e)))
+                if stopped:
+                    return
+        finally:
+            connection.close()
+
+    def beat(self):
+        if not self.writes:
+            return
+        # the locks first, so they expire before the tasks go stale
+        for lock in self.locks:
+            refresh_lock(*lock)
+        ImportTask.objects.filter(pk__in=self.import_task_ids,
+                                  status__in=(ImportTask.STATUS_PENDING, ImportTask.STATUS_RUNNING)
+                                  ).update(updated=timezone.now())
+
+
+def wait_import(import_task, timeout, should_stop=None):
+    """
+    Waits for the task to finish until the timeout or should_stop() returns True.
+    """
+    deadline = time.time() + timeout
+    while not import_task.is_finished:
+        if time.time() + POLL_INTERVAL > deadline or (should_stop is not None and should_stop()):
+            break
+        time.sleep(POLL_INTERVAL)
+        import_task.refresh_from_db()
+    return import_task
@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+import shutil
+import tempfile
+from collections import defaultdict
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from .auth import issue_exchange_token, get_exchange_token_user
+from .benchmarks.generator import generate, _id
+from .models import ExchangeLock, ExchangeToken, ImportCheckpoint
+from .scheduler import acquire_lock, refresh_lock, release_lock
+from .utils import ImportManager
+
+# the ids the pipelines below got by item type
+LOG = defaultdict(list)
+# a product pipeline call that kills the import, as if its worker died
+KILL_AT = None
+
+
+class WorkerKilled(BaseException):
+    pass
+
+
+class GroupPipeline(object):
+    def process_item(self, item):
+        LOG['Group'].append(item.id)
+
+
+class SkuPipeline(object):
+    def process_item(self, item):
+        LOG['Sku'].append(item.id)
+
+
+class TaxPipeline(object):
+    def process_item(self, item):
+        LOG['Tax'].append((item.name, item.value))
+
+
+class ProductPipeline(object):
+    def process_item(self, item):
+        if KILL_AT is not None and len(LOG['Product']) + 1 == KILL_AT:
+            raise WorkerKilled()
+        LOG['Product'].append(item.id)
+
+
+IMPORT_SETTINGS = {
+    'CML_PROJECT_PIPELINES': 'cml.tests',
+    'CML_USE_IMAGE_STORE': False,
+    'CML_IMPORT_PROCESSES': 0,
+    'CML_IMPORT_WRITERS': 0,
+    'CML_TRANSACTION_CHUNK_SIZE': 0,
+}
+
+
+@override_settings(**IMPORT_SETTINGS)
+class ImportTestCase(TestCase):
+
+    PRODUCTS = 20
+
+    @classmethod
+    def setUpClass(cls):
+        super(ImportTestCase, cls).setUpClass()
+        cls.package_dir = tempfile.mkdtemp()
+        cls.file_path = generate(cls.package_dir, groups=3, properties=2, products=cls.PRODUCTS,
+                                 orders=0)[u'import.xml']
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.package_dir)
+        super(ImportTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        global KILL_AT
+        KILL_AT = None
+        LOG.clear()
+
+    @property
+    def product_ids(self):
+        return [_id(u'prd', index) for index in range(self.PRODUCTS)]
+
+    def import_file(self):
+        import_manager = ImportManager(self.file_path)
+        import_manager.import_all()
+        return import_manager
+
+
+@override_settings(CML_USE_FINGERPRINTS=False, CML_CHECKPOINT_INTERVAL=5)
+class CheckpointTest(ImportTestCase):
+
+    def test_retry_resumes_from_checkpoint(self):
+        global KILL_AT
+        KILL_AT = 13
+        with self.assertRaises(WorkerKilled):
+            self.import_file()
+        killed = list(LOG['Product'])
+        handled = ImportCheckpoint.objects.get().handled
+        self.assertTrue(handled)
+        KILL_AT = None
+        LOG.clear()
+        import_manager = self.import_file()
+        retried = LOG['Product']
+        self.assertEqual(import_manager.stats['resumed_from'], handled)
+        # nothing is lost, only the products after the checkpoint are imported again
+        self.assertLess(len(retried), self.PRODUCTS)
+        self.assertEqual(killed[:self.PRODUCTS - len(retried)] + retried, self.product_ids)
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+    def test_checkpoint_of_changed_file_is_reset(self):
+        global KILL_AT
+        KILL_AT = 13
+        with self.assertRaises(WorkerKilled):
+            self.import_file()
+        ImportCheckpoint.objects.update(signature=u'another version')
+        KILL_AT = None
+        LOG.clear()
+        self.import_file()
+        self.assertEqual(len(LOG['Product']), self.PRODUCTS)
+
+
+@override_settings(CML_USE_FINGERPRINTS=True, CML_CHECKPOINT_INTERVAL=0)
+class FingerprintTest(ImportTestCase):
+
+    def test_unchanged_items_are_skipped(self):
+        self.import_file()
+        self.assertEqual(len(LOG['Product']), self.PRODUCTS)
+        LOG.clear()
+        import_manager = self.import_file()
+        self.assertEqual(LOG['Product'], [])
+        self.assertEqual(import_manager.stats['skipped']['Product'], self.PRODUCTS)
+
+
+@override_settings(CML_USE_FINGERPRINTS=False, CML_CHECKPOINT_INTERVAL=0)
+class DeduplicationTest(ImportTestCase):
+
+    def test_related_items_are_passed_once(self):
+        import_manager = self.import_file()
+        self.assertEqual(len(LOG['Product']), self.PRODUCTS)
+        self.assertEqual(len(LOG['Sku']), len(set(LOG['Sku'])))
+        self.assertEqual(len(LOG['Tax']), len(set(LOG['Tax'])))
+        self.assertEqual(len(LOG['Sku']) + import_manager.stats['duplicates']['Sku'], self.PRODUCTS)
+
+
+def create_user(username, **kwargs):
+    # the project's user model has a manager of its own
+    return get_user_model().objects.create(email=u'{}@example.com'.format(username), is_active=True,
+                                           **dict({get_user_model().USERNAME_FIELD: username}, **kwargs))
+
+
+class ExchangeTokenTest(TestCase):
+
+    def setUp(self):
+        self.user = create_user(u'exchange', is_superuser=True)
+
+    def test_live_token(self):
+        token = issue_exchange_token(self.user)
+        self.assertEqual(get_exchange_token_user(token, 'cml.add_exchange'), self.user)
+        self.assertIsNone(get_exchange_token_user(token + u'x', 'cml.add_exchange'))
+
+    def test_expired_token(self):
+        token = issue_exchange_token(self.user)
+        ExchangeToken.objects.update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(get_exchange_token_user(token, 'cml.add_exchange'))
+
+    def test_inactive_user(self):
+        token = issue_exchange_token(self.user)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(get_exchange_token_user(token, 'cml.add_exchange'))
+
+    def test_permission(self):
+        user = create_user(u'staff')
+        self.assertIsNone(get_exchange_token_user(issue_exchange_token(user), 'cml.add_exchange'))
+
+
+class ExchangeLockTest(TestCase):
+
+    def test_lock_is_exclusive(self):
+        token = acquire_lock(u'import:import.xml')
+        self.assertIsNotNone(token)
+        self.assertIsNone(acquire_lock(u'import:import.xml'))
+        release_lock(u'import:import.xml', token)
+        self.assertIsNotNone(acquire_lock(u'import:import.xml'))
+
+    def test_expired_lock_is_taken_over(self):
+        token = acquire_lock(u'import:import.xml')
+        ExchangeLock.objects.update(expires=timezone.now() - timedelta(seconds=1))
+        new_token = acquire_lock(u'import:import.xml')
+        self.assertIsNotNone(new_token)
+        # the old holder can neither refresh nor release it
+        refresh_lock(u'import:import.xml', token)
+        release_lock(u'import:import.xml', token)
+        self.assertEqual(ExchangeLock.objects.get().token, new_token)
+        self.assertIsNone(acquire_lock(u'import:import.xml'))
@@ -1,53 +1,854 @@
 # -*- coding: utf-8 -
 from __future__ import absolute_import
 import os
+import sys
+import glob
+import time
+import codecs
+import hashlib
 import logging
 import importlib
-from io import BytesIO
+import shutil
+import zipfile
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+from xml.sax.saxutils import quoteattr
 import six
+from six.moves import queue
 try:
-    from xml.etree import cElementTree as ET
+    import resource
 except ImportError:
-    from xml.etree import ElementTree as ET
+    resource = None
+try:
+    import billiard
+except ImportError:
+    billiard = None
 from .items import *
+from .parsing import *
+from .etree import get_backend
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from .models import ItemFingerprint, ImportCheckpoint, StoredImage
 from .conf import settings
 
 logger = logging.getLogger(__name__)
 
+# elements setting the state of their section are handled on resume too
+STATE_TAGS = (u'СодержитТолькоИзменения',)
+
+COPY_BUFFER_SIZE = 64 * 1024
+PARTIAL_SUFFIX = u'.part'
+
+
+def reset_peak_memory():
+    """
+    Resets the peak RSS of the process, so get_peak_memory() measures from now on.
+    Returns False where it can't be reset, Linux before 4.0 or another OS.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def get_peak_memory():
+    """
+    Returns the peak RSS of the process in kilobytes since reset_peak_memory() or since
+    the process started where it can't be reset, 0 where it can't be measured.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return 0
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak_memory // 1024 if sys.platform == 'darwin' else peak_memory
+
+
+class PeakMemory(object):
+    """
+    The peak RSS of the process during an exchange, from start() to stop(). Only the first
+    of the exchanges running in the process at once resets the peak, a reset would lose the
+    peaks of the others, so the ones running at once share it.
+    """
+
+    _lock = threading.Lock()
+    _running = 0
+
+    def __init__(self):
+        self.peak = 0
+        self._running_self = False
+
+    def start(self):
+        with PeakMemory._lock:
+            if not PeakMemory._running:
+                reset_peak_memory()
+            PeakMemory._running += 1
+        self._running_self = True
+
+    def stop(self):
+        if self._running_self:
+            self.peak = get_peak_memory()
+            self._running_self = False
+            with PeakMemory._lock:
+                PeakMemory._running -= 1
+        return self.peak
+
+    def get(self):
+        return get_peak_memory() if self._running_self else self.peak
+
+
+def get_partial_path(file_path, session_key=u''):
+    # the parts of a file sent by different exchanges never mix
+    session_hash = hashlib.sha1(session_key.encode('utf-8')).hexdigest()[:12]
+    return u'{}.{}{}'.format(file_path, session_hash, PARTIAL_SUFFIX)
+
+
+def append_upload(stream, file_path, session_key=u'', expected_size=None):
+    """
+    Streams a part of an uploaded file to the end of its partial file.
+    If the transfer breaks or brings other than expected_size bytes, the partial
+    file is truncated back, so the part can be sent again. Returns the number of bytes written.
+    """
+    partial_path = get_partial_path(file_path, session_key)
+    with open(partial_path, 'ab') as f:
+        start = f.tell()
+        try:
+            while True:
+                chunk = stream.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+            written = f.tell() - start
+            if expected_size is not None and written != expected_size:
+                raise IOError('Got {} bytes of {}'.format(written, expected_size))
+        except Exception:
+            f.truncate(start)
+            raise
+        return written
+
+
+def finalize_upload(file_path, session_key=u''):
+    """
+    Makes the partial file importable. Returns False if there is nothing to finalize.
+    """
+    partial_path = get_partial_path(file_path, session_key)
+    if not os.path.exists(partial_path):
+        return False
+    os.replace(partial_path, file_path)
+    if settings.CML_USE_ZIP and is_archive(file_path):
+        extract_archive(file_path)
+    elif settings.CML_USE_IMAGE_STORE and is_image(file_path):
+        ImageStore().add_file(file_path)
+    return True
+
+
+def finalize_uploads(session_key=u'', src_dir=None):
+    src_dir = src_dir or settings.CML_UPLOAD_ROOT
+    partial_suffix = get_partial_path(u'', session_key)
+    for partial_path in glob.glob(os.path.join(glob.escape(src_dir), u'*' + partial_suffix)):
+        finalize_upload(partial_path[:-len(partial_suffix)], session_key)
+
+
+def remove_partial_uploads(max_age, src_dir=None):
+    """
+    Removes the partial files not written to for max_age seconds, their exchanges are gone.
+    """
+    src_dir = src_dir or settings.CML_UPLOAD_ROOT
+    for partial_path in glob.glob(os.path.join(glob.escape(src_dir), u'*' + PARTIAL_SUFFIX)):
+        try:
+            if os.path.getmtime(partial_path) < time.time() - max_age:
+                os.remove(partial_path)
+        except OSError:
+            logger.error('Can\'t delete partial file: {}'.format(partial_path))
+
+
+def is_archive(file_path):
+    return zipfile.is_zipfile(file_path)
+
+
+def is_image(file_path):
+    return os.path.splitext(file_path)[1].lower() in settings.CML_IMAGE_EXTENSIONS
+
+
+def extract_archive(file_path, dst_dir=None):
+    """
+    Extracts everything but the XML files from the zip package into dst_dir
+    (images are flattened the same way _parse_product resolves them) or
+    into the image store. XML files are read by ImportManager straight from the archive.
+    """
+    dst_dir = dst_dir or settings.CML_UPLOAD_ROOT
+    image_store = ImageStore() if settings.CML_USE_IMAGE_STORE else None
+    with zipfile.ZipFile(file_path) as archive:
+        for info in archive.infolist():
+            filename = os.path.basename(info.filename)
+            if not filename or filename.lower().endswith(u'.xml'):
+                continue
+            with archive.open(info) as src:
+                if image_store is not None and is_image(filename):
+                    image_store.add_stream(src, filename)
+                    continue
+                with open(os.path.join(dst_dir, filename), 'wb') as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def find_archive_member(filename, src_dir=None):
+    """
+    Looks for filename inside the zip packages uploaded to src_dir, newest first.
+    Returns (archive_path, member_name) or (None, None).
+    """
+    src_dir = src_dir or settings.CML_UPLOAD_ROOT
+    try:
+        archive_names = [name for name in os.listdir(src_dir) if name.lower().endswith(u'.zip')]
+    except OSError:
+        return None, None
+    archive_paths = sorted((os.path.join(src_dir, name) for name in archive_names),
+                           key=os.path.getmtime, reverse=True)
+    for archive_path in archive_paths:
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                for member_name in archive.namelist():
+                    if os.path.basename(member_name) == filename:
+                        return archive_path, member_name
+        except zipfile.BadZipfile:
+            logger.error('Bad zip package: {}'.format(archive_path))
+    return None, None
+
+
+def find_package_files(names, src_dir=None):
+    """
+    Returns (filename, file_path, archive_path) of the XML files named in names uploaded
+    to src_dir and of the XML members of the zip packages among them. Loose files go first.
+    """
+    src_dir = src_dir or settings.CML_UPLOAD_ROOT
+    package_files = []
+    names = sorted(name for name in set(names) if os.path.isfile(os.path.join(src_dir, name)))
+    filenames = set()
+    for name in names:
+        if name.lower().endswith(u'.xml'):
+            package_files.append((name, os.path.join(src_dir, name), None))
+            filenames.add(name)
+    if not settings.CML_USE_ZIP:
+        return package_files
+    for name in names:
+        if not name.lower().endswith(u'.zip'):
+            continue
+        archive_path = os.path.join(src_dir, name)
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                member_names = archive.namelist()
+        except zipfile.BadZipfile:
+            logger.error('Bad zip package: {}'.format(archive_path))
+            continue
+        for member_name in member_names:
+            filename = os.path.basename(member_name)
+            if filename.lower().endswith(u'.xml') and filename not in filenames:
+                package_files.append((filename, member_name, archive_path))
+                filenames.add(filename)
+    return package_files
+
+
+class ProgressReader(object):
+    """
+    File wrapper reporting the read percentage to callback(percent) whenever it changes.
+    """
+
+    def __init__(self, f, size, callback):
+        self._f = f
+        self._size = size
+        self._callback = callback
+        self._read = 0
+        self._percent = -1
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._read += len(data)
+        if self._size:
+            percent = min(100, self._read * 100 // self._size)
+            if percent != self._percent:
+                self._percent = percent
+                self._callback(percent)
+        return data
+
+
+class FingerprintStore(object):
+    """
+    Last seen fingerprints of the imported items, keyed by item type and 1C Ид.
+    New fingerprints are kept in memory until save() is called.
+    """
+
+    def __init__(self):
+        self._fingerprints = {}
+        self._loaded_types = set()
+        self._changed = {}
+        self._discarded = set()
+
+    def _load(self, item_type):
+        fingerprints = ItemFingerprint.objects.filter(item_type=item_type).values_list('item_id', 'fingerprint')
+        for item_id, fingerprint in fingerprints.iterator():
+            self._fingerprints[(item_type, item_id)] = fingerprint
+        self._loaded_types.add(item_type)
+
+    def is_changed(self, item_type, item_id, fingerprint, force=False):
+        if item_type not in self._loaded_types:
+            self._load(item_type)
+        key = (item_type, item_id)
+        if not force and self._fingerprints.get(key) == fingerprint:
+            return False
+        self._changed[key] = fingerprint
+        return True
+
+    def discard(self, item_type, item_id):
+        """
+        Forgets the fingerprint of an item changed bypassing them, so the next import processes it.
+        """
+        self._discarded.add((item_type, item_id))
+        self._changed.pop((item_type, item_id), None)
+
+    def save(self, exclude=()):
+        discarded = {}
+        for item_type, item_id in self._discarded:
+            discarded.setdefault(item_type, []).append(item_id)
+            self._fingerprints.pop((item_type, item_id), None)
+        for item_type, item_ids in discarded.items():
+            for start in range(0, len(item_ids), 1000):
+                ItemFingerprint.objects.filter(item_type=item_type,
+                                               item_id__in=item_ids[start:start + 1000]).delete()
+        self._discarded = set()
+        fingerprints = [ItemFingerprint(item_type=item_type, item_id=item_id, fingerprint=fingerprint)
+                        for (item_type, item_id), fingerprint in self._changed.items()
+                        if (item_type, item_id) not in exclude]
+        ItemFingerprint.objects.bulk_create(fingerprints, batch_size=1000, update_conflicts=True,
+                                            unique_fields=['item_type', 'item_id'],
+                                            update_fields=['fingerprint', 'updated'])
+        self._fingerprints.update(self._changed)
+        self._changed = {}
+
+
+class ImageStore(object):
+    """
+    Product pictures stored once per content as root/<hash[:2]>/<hash><extension>.
+    StoredImage rows map the 1C file names to the content hashes, a picture 1C
+    sends again with the same content only updates its row.
+    """
+
+    # blobs newer than that are never swept, their rows may be being written
+    SWEEP_GRACE_SECONDS = 60 * 60
+
+    def __init__(self, root=None):
+        self.root = root or settings.CML_IMAGE_ROOT
+        self._hashes = None
+        self._used = set()
+
+    def get_blob_path(self, content_hash, filename):
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(self.root, content_hash[:2], content_hash + extension)
+
+    def add_file(self, file_path, filename=None):
+        """
+        Moves the file into the store or removes it if the same content is there already.
+        Returns the path of the blob.
+        """
+        content_hash = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(partial(f.read, COPY_BUFFER_SIZE), b''):
+                content_hash.update(chunk)
+        return self._store(file_path, content_hash.hexdigest(), filename or os.path.basename(file_path))
+
+    def add_stream(self, stream, filename):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        content_hash = hashlib.sha1()
+        with tempfile.NamedTemporaryFile(dir=self.root, suffix=PARTIAL_SUFFIX, delete=False) as f:
+            for chunk in iter(partial(stream.read, COPY_BUFFER_SIZE), b''):
+                content_hash.update(chunk)
+                f.write(chunk)
+        return self._store(f.name, content_hash.hexdigest(), filename)
+
+    def _store(self, file_path, content_hash, filename):
+        blob_path = self.get_blob_path(content_hash, filename)
+        if os.path.exists(blob_path):
+            os.remove(file_path)
+            # keeps the blob out of a sweep running right now
+            os.utime(blob_path)
+        else:
+            if not os.path.exists(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            shutil.move(file_path, blob_path)
+        StoredImage.objects.update_or_create(filename=filename, defaults={'content_hash': content_hash,
+                                                                          'last_used': timezone.now()})
+        return blob_path
+
+    def get_path(self, filename):
+        """
+        Returns the blob path of the 1C file name or None, and marks the image used.
+        """
+        if self._hashes is None:
+            self._hashes = dict(StoredImage.objects.values_list('filename', 'content_hash').iterator())
+        content_hash = self._hashes.get(filename)
+        if content_hash is None:
+            return None
+        self._used.add(filename)
+        return self.get_blob_path(content_hash, filename)
+
+    def save_usage(self):
+        used = list(self._used)
+        now = timezone.now()
+        for start in range(0, len(used), 1000):
+            StoredImage.objects.filter(filename__in=used[start:start + 1000]).update(last_used=now)
+        self._used = set()
+
+    def sweep(self, max_age, image_paths):
+        """
+        Removes the blobs none of image_paths (the image_path of every product there is)
+        refers to, unless an import used their 1C file name within max_age (a timedelta).
+        Returns the number of removed blobs and their size in bytes.
+        """
+        content_hashes = set(os.path.splitext(os.path.basename(image_path))[0]
+                             for image_path in image_paths if image_path)
+        # the names of the images the products refer to are kept, 1C may refer to them without sending them again
+        stale_ids = [stored_id for stored_id, content_hash in StoredImage.objects.filter(
+            last_used__lt=timezone.now() - max_age).values_list('id', 'content_hash').iterator()
+            if content_hash not in content_hashes]
+        for start in range(0, len(stale_ids), 1000):
+            StoredImage.objects.filter(id__in=stale_ids[start:start + 1000]).delete()
+        content_hashes.update(StoredImage.objects.values_list('content_hash', flat=True).iterator())
+        removed = removed_size = 0
+        grace_time = time.time() - self.SWEEP_GRACE_SECONDS
+        for dir_path, dir_names, file_names in os.walk(self.root, topdown=False):
+            for file_name in file_names:
+                blob_path = os.path.join(dir_path, file_name)
+                if os.path.splitext(file_name)[0] in content_hashes:
+                    continue
+                try:
+                    stat = os.stat(blob_path)
+                    if stat.st_mtime > grace_time:
+                        continue
+                    os.remove(blob_path)
+                except OSError:
+                    logger.error('Can\'t delete image: {}'.format(blob_path))
+                    continue
+                removed += 1
+                removed_size += stat.st_size
+            if dir_path != self.root and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+        return removed, removed_size
+
+
+def get_file_section(file_path, archive_path=None):
+    """
+    Returns the tag of the first section of the file, e.g. Классификатор, or u''.
+    """
+    try:
+        if archive_path is not None:
+            with zipfile.ZipFile(archive_path) as archive, archive.open(file_path) as f:
+                return _read_first_section(f)
+        with open(file_path, 'rb') as f:
+            return _read_first_section(f)
+    except Exception as e:
+        logger.error('Can\'t read the first section of {}: {}'.format(file_path, repr(e)))
+        return u''
+
+
+def _read_first_section(f):
+    depth = 0
+    for event, element in get_backend().iterparse(f, events=('start', 'end')):
+        if event == 'end':
+            depth -= 1
+            continue
+        if depth == 1:
+            return element.tag
+        depth += 1
+    return u''
+
+
+class ImportPackage(object):
+    """
+    The files of one exchange package imported in the order of their sections
+    with one item processor, so the pipelines, the reference cache, the
+    fingerprints and the seen Sku/Tax items are loaded once per package.
+    """
+
+    SECTION_ORDER = (u'Классификатор', u'Каталог', u'ПакетПредложений', u'Документ')
+
+    def __init__(self):
+        self.item_processor = get_item_processor()
+        self.fingerprints = FingerprintStore() if settings.CML_USE_FINGERPRINTS else None
+        self.images = ImageStore() if settings.CML_USE_IMAGE_STORE else None
+        self.seen_states = {}
+
+    @classmethod
+    def get_file_rank(cls, file_path, archive_path=None):
+        section = get_file_section(file_path, archive_path)
+        try:
+            return cls.SECTION_ORDER.index(section)
+        except ValueError:
+            return len(cls.SECTION_ORDER)
+
+    def get_import_manager(self, file_path, archive_path=None):
+        return ImportManager(file_path, archive_path, package=self)
+
 
 class ImportManager(object):
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, archive_path=None, package=None):
+        # with archive_path, file_path is the name of a member of that zip package
         self.file_path = file_path
-        self.tree = None
-        self.item_processor = ItemProcessor()
+        self.archive_path = archive_path
+        self.progress_callback = None
+        self.etree = get_backend()
+        self.keep_xml_elements = settings.CML_KEEP_XML_ELEMENTS
+        if package is not None:
+            # the files of a package share the pipelines and the caches
+            self.item_processor = package.item_processor
+            self.fingerprints = package.fingerprints
+            self.images = package.images
+        else:
+            self.item_processor = get_item_processor()
+            self.fingerprints = FingerprintStore() if settings.CML_USE_FINGERPRINTS else None
+            self.images = ImageStore() if settings.CML_USE_IMAGE_STORE else None
+        self.checkpoint_interval = settings.CML_CHECKPOINT_INTERVAL
+        self.offers_update_only_changes = settings.CML_OFFERS_UPDATE_ONLY_CHANGES
+        self.checkpoint = None
+        # handled elements of the file so far and how many of them were stored by the last run
+        self._handled = 0
+        self._resume_from = 0
+        # set by the СодержитТолькоИзменения flag of the current section
+        self.only_changes = False
+        self.stats = {'changed': Counter(), 'skipped': Counter(), 'seconds': Counter(), 'bytes': 0,
+                      'total_seconds': 0, 'duplicates': Counter(), 'resumed_from': 0}
+        # states of the DEDUPLICATED_ITEMS already passed to the pipelines by item type
+        self._seen_states = package.seen_states if package is not None else {}
+        # the counters of a shared item processor before this file
+        self._processor_counters = (Counter(), Counter(), Counter())
+        self._started = None
+        self.processes = settings.CML_IMPORT_PROCESSES
+        self._pool = None
+        self._chunk = []
+        self._chunk_handler_name = None
+        self._pending_chunks = deque()
+        self.peak_memory = PeakMemory()
 
     def import_all(self):
+        handlers = {}
+        handlers.update(self._get_classifier_handlers())
+        handlers.update(self._get_catalogue_handlers())
+        handlers.update(self._get_offers_pack_handlers())
+        handlers.update(self._get_orders_handlers())
+        self._processor_counters = (Counter(self.item_processor.processed), Counter(self.item_processor.errors),
+                                    Counter(self.item_processor.seconds))
+        self.peak_memory.start()
+        started = self._started = time.time()
         try:
-            self.tree = self._get_tree()
+            self._iterparse(handlers)
         except Exception:
-            logger.error('Import all error!')
-            return
-        self.import_classifier()
-        self.import_catalogue()
-        self.import_offers_pack()
-        self.import_orders()
+            logger.exception('Import all error!')
+            raise
+        finally:
+            self.stats['total_seconds'] = time.time() - started
+            self.peak_memory.stop()
         logger.info('Import success!')
+        return True
 
-    def _get_tree(self):
-        if self.tree is not None:
-            return self.tree
+    def get_metrics(self):
+        """
+        Returns the metrics of the import as ExchangeMetrics fields.
+        """
+        processed_before, errors_before, seconds_before = self._processor_counters
+        processed = self.item_processor.processed - processed_before
+        errors = self.item_processor.errors - errors_before
+        commits = [commit for commit in self.item_processor.commits if commit[0] >= self._started]
+        lock_seconds = [seconds for started, seconds, commit_seconds in commits]
+        commit_seconds = [commit_seconds for started, seconds, commit_seconds in commits]
+        return {
+            'seconds': self.stats['total_seconds'],
+            'items': sum(processed.values()),
+            'errors': sum(errors.values()),
+            'bytes': self.stats['bytes'],
+            'peak_memory': self.peak_memory.get(),
+            'section_seconds': dict(self.stats['seconds']),
+            'pipeline_seconds': dict(self.item_processor.seconds - seconds_before),
+            'item_counts': dict(processed),
+            'error_counts': dict(errors),
+            'duplicate_counts': dict(self.stats['duplicates']),
+            'commits': len(commits),
+            'commit_seconds': sum(commit_seconds),
+            'max_commit_seconds': max(commit_seconds or [0]),
+            'lock_seconds': sum(lock_seconds),
+            'max_lock_seconds': max(lock_seconds or [0]),
+        }
+
+    @contextmanager
+    def _open_file(self):
+        if self.archive_path is not None:
+            with zipfile.ZipFile(self.archive_path) as archive:
+                with archive.open(self.file_path) as f:
+                    self.stats['bytes'] = archive.getinfo(self.file_path).file_size
+                    yield self._wrap_progress(f, self.stats['bytes'])
+            return
         if not os.path.exists(self.file_path):
             message = 'File not found {}'.format(self.file_path)
             logger.error(message)
             raise OSError(message)
+        with open(self.file_path, 'rb') as f:
+            self.stats['bytes'] = os.path.getsize(self.file_path)
+            yield self._wrap_progress(f, self.stats['bytes'])
+
+    @contextmanager
+    def _open_pool(self):
+        if self.processes < 2:
+            yield
+            return
+        if threading.current_thread() is not threading.main_thread():
+            # e.g. the import thread of a web process, the other threads can't be forked safely
+            logger.info('Import runs in a thread, parsing without a process pool')
+            yield
+            return
+        if not multiprocessing.current_process().daemon:
+            self._pool = multiprocessing.get_context('fork').Pool(self.processes)
+        elif billiard is not None:
+            # a prefork Celery worker, only billiard lets a daemon process have children
+            self._pool = billiard.Pool(self.processes)
+        else:
+            logger.info('Import runs in a daemon process, parsing without a process pool')
+            yield
+            return
         try:
-            tree = ET.parse(self.file_path)
-        except Exception as e:
-            message = 'File parse error {}'.format(self.file_path)
-            logger.error(message)
-            raise e
-        return tree
+            yield
+        finally:
+            self._pool.terminate()
+            self._pool = None
+            self._chunk = []
+            self._pending_chunks.clear()
+
+    @contextmanager
+    def _open_writers(self):
+        if not isinstance(self.item_processor, ConcurrentItemProcessor):
+            yield
+            return
+        if connection.in_atomic_block:
+            # the connections of the writer threads would be out of the transaction
+            logger.info('Import runs in a transaction, writing without writer threads')
+            yield
+            return
+        self.item_processor.start()
+        try:
+            yield
+        finally:
+            self.item_processor.stop()
+
+    def _parse_in_pool(self, handler_name, element):
+        """
+        Collects elements into chunks parsed by the pool processes. The parsed items
+        come back in the original order and are processed here, in this process.
+        """
+        if self._pool is None:
+            return getattr(self, handler_name)(element)
+        if self._chunk and handler_name != self._chunk_handler_name:
+            self._submit_chunk()
+        self._chunk_handler_name = handler_name
+        self._chunk.append(self.etree.tostring(element, encoding='utf-8'))
+        if len(self._chunk) >= settings.CML_IMPORT_CHUNK_SIZE:
+            self._submit_chunk()
+        # don't let parsed chunks pile up when the pipelines are slower than parsing
+        while len(self._pending_chunks) > self.processes * 2:
+            self._process_chunk_result(self._pending_chunks.popleft())
+
+    def _submit_chunk(self):
+        chunk_result = self._pool.apply_async(_parse_chunk, (self._chunk_handler_name, self._chunk))
+        self._pending_chunks.append(chunk_result)
+        self._chunk = []
+
+    def _process_chunks(self):
+        if self._chunk:
+            self._submit_chunk()
+        while self._pending_chunks:
+            self._process_chunk_result(self._pending_chunks.popleft())
+
+    def _process_chunk_result(self, chunk_result):
+        for item, before, after in chunk_result.get():
+            self._process_if_changed(item, before, after)
+
+    def _wrap_progress(self, f, size):
+        if self.progress_callback is None:
+            return f
+        return ProgressReader(f, size, self.progress_callback)
+
+    def _iterparse(self, handlers):
+        """
+        Streams the file and calls handlers[path](element) for every element
+        whose path relative to the root is in handlers, as soon as it closes.
+        Handled elements and everything outside of them are cleared right away,
+        so memory usage doesn't depend on the file size.
+        """
+        self.item_processor.preload_references()
+        self._load_checkpoint()
+        with self._open_file() as f, self._open_pool(), self._open_writers():
+            try:
+                self._iterparse_file(f, handlers)
+                self._process_chunks()
+            except Exception as e:
+                message = 'File parse error {}'.format(self.file_path)
+                logger.error(message)
+                raise e
+            finally:
+                self.item_processor.flush_items()
+        if self.fingerprints is not None:
+            self.fingerprints.save(exclude=self.item_processor.failed_items)
+        if self.images is not None:
+            self.images.save_usage()
+        if self.checkpoint is not None:
+            self.checkpoint.delete()
+            self.checkpoint = None
+        logger.info('Import stats: changed {}, skipped {}, duplicates {}'.format(
+            dict(self.stats['changed']), dict(self.stats['skipped']), dict(self.stats['duplicates'])))
+
+    def _iterparse_file(self, f, handlers):
+        elements = []
+        paths = []
+        handled_depth = 0
+        section_started = None
+        for event, element in self.etree.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                path = paths[-1] + (element.tag,) if paths else ()
+                if len(path) == 1:
+                    section_started = time.time()
+                if path in handlers:
+                    handled_depth += 1
+                elif len(path) == 1:
+                    self._start_section(element)
+                elements.append(element)
+                paths.append(path)
+                continue
+            path = paths.pop()
+            elements.pop()
+            if path in handlers:
+                handled_depth -= 1
+                self._handle(handlers[path], path, element)
+            elif handled_depth or not elements:
+                # the element is a part of a handled one or it is the root
+                continue
+            elif len(path) == 1:
+                self._end_section(element)
+            if not (self.keep_xml_elements and path in handlers):
+                # a handled one may be kept by its items until their batch is written, detaching it is enough
+                element.clear()
+            elements[-1].remove(element)
+            if len(path) == 1:
+                self.stats['seconds'][path[0]] += time.time() - section_started
+
+    def _handle(self, handler, path, element):
+        self._handled += 1
+        if self._handled <= self._resume_from and path[-1] not in STATE_TAGS:
+            # stored by the last run
+            if self._handled == self._resume_from:
+                self._check_resume_position(path, element)
+            return
+        handler(element)
+        if self.checkpoint is not None and not self._handled % self.checkpoint_interval:
+            self._save_checkpoint(path, element)
+
+    def _get_file_signature(self):
+        if self.archive_path is not None:
+            with zipfile.ZipFile(self.archive_path) as archive:
+                info = archive.getinfo(self.file_path)
+                return u'{}:{}'.format(info.file_size, info.CRC), u'{}:{}'.format(self.archive_path, self.file_path)
+        stat = os.stat(self.file_path)
+        return u'{}:{}'.format(stat.st_size, stat.st_mtime_ns), os.path.abspath(self.file_path)
+
+    def _load_checkpoint(self):
+        """
+        Continues after the checkpoint of the last run of the same file,
+        another version of the file is imported from the start.
+        """
+        if not self.checkpoint_interval:
+            return
+        signature, file_key = self._get_file_signature()
+        checkpoint, created = ImportCheckpoint.objects.get_or_create(file_key=file_key,
+                                                                      defaults={'signature': signature})
+        if not created and checkpoint.signature != signature:
+            checkpoint.reset(signature)
+        self.checkpoint = checkpoint
+        self._handled = 0
+        self._resume_from = checkpoint.handled
+        if self._resume_from:
+            logger.info('Resuming import of {} after {} elements, {} {}'.format(
+                file_key, checkpoint.handled, checkpoint.section, checkpoint.last_id))
+        self.stats['resumed_from'] = self._resume_from
+
+    def _check_resume_position(self, path, element):
+        last_id = element.findtext(u'Ид') or u''
+        if path[0] == self.checkpoint.section and last_id == self.checkpoint.last_id:
+            return
+        # the next run starts over
+        self.checkpoint.reset(self.checkpoint.signature)
+        raise ValueError('Checkpoint {} {} doesn\'t match the file, found {} {}'.format(
+            self.checkpoint.section, self.checkpoint.last_id, path[0], last_id))
+
+    def _save_checkpoint(self, path, element):
+        # everything handled so far is stored before the checkpoint moves past it
+        self._process_chunks()
+        self.item_processor.flush_items()
+        if self.fingerprints is not None:
+            self.fingerprints.save(exclude=self.item_processor.failed_items)
+        self.checkpoint.section = path[0]
+        self.checkpoint.handled = self._handled
+        self.checkpoint.last_id = element.findtext(u'Ид') or u''
+        self.checkpoint.save(update_fields=['section', 'handled', 'last_id', 'updated'])
+
+    def _start_section(self, section_element):
+        self.only_changes = section_element.get(u'СодержитТолькоИзменения') == u'true'
+
+    def _parse_only_changes(self, only_changes_element):
+        self.only_changes = self._get_cleaned_text(only_changes_element) == u'true'
+
+    def _process_if_changed(self, item, before=(), after=()):
+        """
+        Processes the item along with its related items, unless they are the same
+        as in the last import. Items from sections with only changes are always processed.
+        """
+        item_type = item.__class__.__name__
+        if self.images is not None and item_type == 'Product' and item.image_path:
+            # the blob path changes with the content, so does the fingerprint
+            item.image_path = self.images.get_path(os.path.basename(item.image_path)) or item.image_path
+        if self.fingerprints is not None:
+            fingerprint = item.get_fingerprint(*(tuple(before) + tuple(after)))
+            if not self.fingerprints.is_changed(item_type, item.id, fingerprint, force=self.only_changes):
+                self.stats['skipped'][item_type] += 1
+                return
+        self.stats['changed'][item_type] += 1
+        for related_item in before:
+            self._process_related(related_item)
+        self.item_processor.process_item(item)
+        for related_item in after:
+            self._process_related(related_item)
+
+    def _process_related(self, item):
+        item_type = item.__class__.__name__
+        if item_type in DEDUPLICATED_ITEMS:
+            seen_states = self._seen_states.setdefault(item_type, set())
+            state = item.get_state()
+            if state in seen_states:
+                self.stats['duplicates'][item_type] += 1
+                return
+            seen_states.add(state)
+        self.item_processor.process_item(item)
+
+    def _end_section(self, section_element):
+        # items of the section are referenced by the next ones, so batches are written here
+        self._process_chunks()
+        self.item_processor.flush_items()
 
     def _get_cleaned_text(self, element):
         try:
@@ -60,287 +861,440 @@ class ImportManager(object):
 
     def import_classifier(self):
         try:
-            tree = self._get_tree()
+            self._iterparse(self._get_classifier_handlers())
         except Exception:
-            logger.error('Import classifier error!')
-            return
-        classifier_element = tree.find(u'Классификатор')
-        if classifier_element is not None:
-            self._parse_groups(classifier_element)
-            self._parse_properties(classifier_element)
-
-    def _parse_groups(self, current_element, parent_item=None):
-        for group_element in current_element.findall(u'Группы/Группа'):
-            group_item = Group(group_element)
-            group_item.id = self._get_cleaned_text(group_element.find(u'Ид'))
-            group_item.name = self._get_cleaned_text(group_element.find(u'Наименование'))
-            if parent_item is not None:
-                parent_item.groups.append(group_item)
-            self._parse_groups(group_element, group_item)
+            logger.exception('Import classifier error!')
+            raise
+
+    def _get_classifier_handlers(self):
+        return {
+            (u'Классификатор', u'Группы', u'Группа'): self._parse_group,
+            (u'Классификатор', u'Свойства', u'Свойство'): self._parse_property,
+        }
+
+    def _parse_group(self, group_element, parent_item=None):
+        group_item = Group(group_element)
+        parse_children(self, group_element, group_item, GROUP_HANDLERS)
+        if parent_item is not None:
+            parent_item.groups.append(group_item)
+        else:
             # processing only top level groups
-            if parent_item is None:
-                self.item_processor.process_item(group_item)
-
-    def _parse_properties(self, current_element):
-        for property_element in current_element.findall(u'Свойства/Свойство'):
-            property_item = Property(property_element)
-            property_item.id = self._get_cleaned_text(property_element.find(u'Ид'))
-            property_item.name = self._get_cleaned_text(property_element.find(u'Наименование'))
-            property_item.value_type = self._get_cleaned_text(property_element.find(u'ТипЗначений'))
-            property_item.for_products = self._get_cleaned_text(property_element.find(u'ДляТоваров')) == u'true'
-            self.item_processor.process_item(property_item)
-            for variant_element in property_element.findall(u'ВариантыЗначений/{}'.format(property_item.value_type)):
-                variant = PropertyVariant(variant_element)
-                variant.id = self._get_cleaned_text(variant_element.find(u'ИдЗначения'))
-                variant.value = self._get_cleaned_text(variant_element.find(u'Значение'))
+            self.item_processor.process_item(group_item)
+
+    def _parse_property(self, property_element):
+        property_item = Property(property_element)
+        tagged_variants = []
+        parse_children(self, property_element, property_item, PROPERTY_HANDLERS, tagged_variants)
+        variants = []
+        for tag, variant in tagged_variants:
+            if tag == property_item.value_type:
                 variant.property_id = property_item.id
-                self.item_processor.process_item(variant)
+                variants.append(variant)
+        self._process_if_changed(property_item, after=variants)
 
     def import_catalogue(self):
         try:
-            tree = self._get_tree()
+            self._iterparse(self._get_catalogue_handlers())
         except Exception:
-            logger.error('Import catalogue error!')
-            return
-        catalogue_element = tree.find(u'Каталог')
-        if catalogue_element is not None:
-            self._parse_products(catalogue_element)
-
-    def _parse_products(self, current_element):
-        for product_element in current_element.findall(u'Товары/Товар'):
-            product_item = Product(product_element)
-            product_item.id = self._get_cleaned_text(product_element.find(u'Ид'))
-            product_item.name = self._get_cleaned_text(product_element.find(u'Наименование'))
-
-            sku_element = product_element.find(u'БазоваяЕдиница')
-            if sku_element is not None:
-                sku_item = Sku(sku_element)
-                sku_item.id = sku_element.get(u'Код')
-                sku_item.name_full = sku_element.get(u'НаименованиеПолное')
-                sku_item.international_abbr = sku_element.get(u'МеждународноеСокращение')
-                sku_item.name = self._get_cleaned_text(sku_element)
-                product_item.sku_id = sku_item.id
-                self.item_processor.process_item(sku_item)
-
-            image_element = product_element.find(u'Картинка')
-            if image_element is not None:
-                image_text = self._get_cleaned_text(image_element)
-                try:
-                    image_filename = os.path.basename(image_text)
-                except Exception:
-                    image_filename = u''
-                if image_filename:
-                    product_item.image_path = os.path.join(settings.CML_UPLOAD_ROOT, image_filename)
-
-            for group_id_element in product_element.findall(u'Группы/Ид'):
-                product_item.group_ids.append(self._get_cleaned_text(group_id_element))
-
-            for property_element in product_element.findall(u'ЗначенияСвойств/ЗначенияСвойства'):
-                property_id = self._get_cleaned_text(property_element.find(u'Ид'))
-                property_variant_id = self._get_cleaned_text(property_element.find(u'Значение'))
-                if property_variant_id:
-                    product_item.properties.append((property_id, property_variant_id))
-
-            for tax_element in product_element.findall(u'СтавкиНалогов/СтавкаНалога'):
-                tax_item = Tax(tax_element)
-                tax_item.name = self._get_cleaned_text(tax_element.find(u'Наименование'))
-                try:
-                    tax_item.value = Decimal(self._get_cleaned_text(tax_element.find(u'Ставка')))
-                except:
-                    tax_item.value = Decimal()
-                self.item_processor.process_item(tax_item)
-                product_item.tax_name = tax_item.name
+            logger.exception('Import catalogue error!')
+            raise
 
-            for additional_field_element in product_element.findall(u'ЗначенияРеквизитов/ЗначениеРеквизита'):
-                additional_field = AdditionalField(additional_field_element)
-                additional_field.name = self._get_cleaned_text(additional_field_element.find(u'Наименование'))
-                additional_field.value = self._get_cleaned_text(additional_field_element.find(u'Значение'))
-                product_item.additional_fields.append(additional_field)
+    def _get_catalogue_handlers(self):
+        return {
+            (u'Каталог', u'СодержитТолькоИзменения'): self._parse_only_changes,
+            (u'Каталог', u'Товары', u'Товар'): partial(self._parse_in_pool, '_parse_product'),
+        }
 
-            self.item_processor.process_item(product_item)
+    def _parse_product(self, product_element):
+        product_item = Product(product_element)
+        related_items = []
+        parse_children(self, product_element, product_item, PRODUCT_HANDLERS, related_items)
+        self._process_if_changed(product_item, before=related_items)
 
     def import_offers_pack(self):
         try:
-            tree = self._get_tree()
+            self._iterparse(self._get_offers_pack_handlers())
         except Exception:
-            logger.error('Import offers pack error!')
+            logger.exception('Import offers pack error!')
+            raise
+
+    def _get_offers_pack_handlers(self):
+        return {
+            (u'ПакетПредложений', u'СодержитТолькоИзменения'): self._parse_only_changes,
+            (u'ПакетПредложений', u'ТипыЦен', u'ТипЦены'): self._parse_price_type,
+            (u'ПакетПредложений', u'Предложения', u'Предложение'): self._parse_offer_or_update,
+        }
+
+    def _parse_offer_or_update(self, offer_element):
+        if self.item_processor.can_update_offers() and (self.only_changes or not self.offers_update_only_changes):
+            self._parse_offer_update(offer_element)
+        else:
+            self._parse_in_pool('_parse_offer', offer_element)
+
+    def _parse_offer_update(self, offer_element):
+        """
+        Reads only the id, prices and stock of the offer, no items are built.
+        """
+        offer_id = u''
+        prices = []
+        quantity = None
+        for child_element in offer_element:
+            tag = child_element.tag
+            if tag == u'Ид':
+                offer_id = (child_element.text or u'').strip(u' ')
+            elif tag == u'Цены':
+                for price_element in child_element:
+                    price_type_id = currency_name = u''
+                    price_for_sku = None
+                    for price_child_element in price_element:
+                        price_tag = price_child_element.tag
+                        if price_tag == u'ИдТипаЦены':
+                            price_type_id = (price_child_element.text or u'').strip(u' ')
+                        elif price_tag == u'ЦенаЗаЕдиницу':
+                            price_for_sku = Decimal((price_child_element.text or u'').strip(u' '))
+                        elif price_tag == u'Валюта':
+                            currency_name = (price_child_element.text or u'').strip(u' ')
+                    if price_for_sku is not None:
+                        prices.append((price_type_id, price_for_sku, currency_name))
+            elif tag == u'Количество':
+                quantity = Decimal((child_element.text or u'').strip(u' '))
+            elif tag == u'Остатки':
+                # CommerceML 2.08+, the sum over the warehouses
+                quantities = [Decimal(text.strip(u' ')) for text in
+                              (element.text for element in child_element.iter(u'Количество')) if text]
+                quantity = sum(quantities, Decimal())
+        if not self.item_processor.can_update_offers(prices=bool(prices), stocks=quantity is not None):
+            # the pipeline can't update this data in batches, the offer goes the usual way
+            self._parse_in_pool('_parse_offer', offer_element)
             return
-        offers_pack_element = tree.find(u'ПакетПредложений')
-        if offers_pack_element is not None:
-            self._parse_price_types(offers_pack_element)
-            self._parse_offers(offers_pack_element)
-
-    def _parse_price_types(self, current_element):
-        for price_type_element in current_element.findall(u'ТипыЦен/ТипЦены'):
-            price_type_item = PriceType(price_type_element)
-            price_type_item.id = self._get_cleaned_text(price_type_element.find(u'Ид'))
-            price_type_item.name = self._get_cleaned_text(price_type_element.find(u'Наименование'))
-            price_type_item.currency = self._get_cleaned_text(price_type_element.find(u'Валюта'))
-            price_type_item.tax_name = self._get_cleaned_text(price_type_element.find(u'Налог/Наименование'))
-            if self._get_cleaned_text(price_type_element.find(u'Налог/УчтеноВСумме')) == u'true':
-                price_type_item.tax_in_sum = True
-            self.item_processor.process_item(price_type_item)
-
-    def _parse_offers(self, current_element):
-        for offer_element in current_element.findall(u'Предложения/Предложение'):
-            offer_item = Offer(offer_element)
-            offer_item.id = self._get_cleaned_text(offer_element.find(u'Ид'))
-            offer_item.name = self._get_cleaned_text(offer_element.find(u'Наименование'))
-
-            sku_element = offer_element.find(u'БазоваяЕдиница')
-            if sku_element is not None:
-                sku_item = Sku(sku_element)
-                sku_item.id = sku_element.get(u'Код')
-                sku_item.name_full = sku_element.get(u'НаименованиеПолное')
-                sku_item.international_abbr = sku_element.get(u'МеждународноеСокращение')
-                sku_item.name = self._get_cleaned_text(sku_element)
-                offer_item.sku_id = sku_item.id
-                self.item_processor.process_item(sku_item)
-
-            for price_element in offer_element.findall(u'Цены/Цена'):
-                price_item = Price(price_element)
-                price_item.representation = self._get_cleaned_text(price_element.find(u'Представление'))
-                price_item.price_type_id = self._get_cleaned_text(price_element.find(u'ИдТипаЦены'))
-                price_item.price_for_sku = Decimal(self._get_cleaned_text(price_element.find(u'ЦенаЗаЕдиницу')))
-                price_item.currency_name = self._get_cleaned_text(price_element.find(u'Валюта'))
-                price_item.sku_name = self._get_cleaned_text(price_element.find(u'Единица'))
-                price_item.sku_ratio = Decimal(self._get_cleaned_text(price_element.find(u'Коэффициент')))
-                offer_item.prices.append(price_item)
-
-            self.item_processor.process_item(offer_item)
+        self.item_processor.update_offer(offer_id, prices, quantity)
+        if self.fingerprints is not None:
+            self.fingerprints.discard('Offer', offer_id)
+
+    def _parse_price_type(self, price_type_element):
+        price_type_item = PriceType(price_type_element)
+        parse_children(self, price_type_element, price_type_item, PRICE_TYPE_HANDLERS)
+        self.item_processor.process_item(price_type_item)
+
+    def _parse_offer(self, offer_element):
+        offer_item = Offer(offer_element)
+        related_items = []
+        parse_children(self, offer_element, offer_item, OFFER_HANDLERS, related_items)
+        self._process_if_changed(offer_item, before=related_items)
 
     def import_orders(self):
         try:
-            tree = self._get_tree()
+            self._iterparse(self._get_orders_handlers())
         except Exception:
-            logger.error('Import orders error!')
-            return
-        orders_elements = tree.find(u'Документ')
-        if orders_elements is not None:
-            self._parse_orders(orders_elements)
-
-    def _parse_orders(self, order_elements):
-        for order_element in order_elements:
-            order_item = Order(order_element)
-            order_item.id = self._get_cleaned_text(order_element.find(u'Ид'))
-            order_item.number = self._get_cleaned_text(order_element.find(u'Номер'))
-            order_item.date = self._get_cleaned_text(order_element.find(u'Дата'))
-            order_item.currency_name = self._get_cleaned_text(order_element.find(u'Валюта'))
-            order_item.currency_rate = self._get_cleaned_text(order_element.find(u'Курс'))
-            order_item.operation = self._get_cleaned_text(order_element.find(u'ХозОперация'))
-            order_item.role = self._get_cleaned_text(order_element.find(u'Роль'))
-            order_item.sum = self._get_cleaned_text(order_element.find(u'Сумма'))
-            order_item.client.id = self._get_cleaned_text(order_element.find(u'Контрагенты/Контрагент/Ид'))
-            order_item.client.name = self._get_cleaned_text(order_element.find(u'Контрагенты/Контрагент/Наименование'))
-            order_item.client.full_name = self._get_cleaned_text(
-                                          order_element.find(u'Контрагенты/Контрагент/ПолноеНаименование'))
-            order_item.time = self._get_cleaned_text(order_element.find(u'Время'))
-            order_item.comment = self._get_cleaned_text(order_element.find(u'Комментарий'))
-            item_elements = order_element.find(u'Товары/Товар')
-            if item_elements is not None:
-                for item_element in item_elements:
-                    order_item_item = OrderItem(item_element)
-                    order_item_item.id = self._get_cleaned_text(item_element.find(u'Ид'))
-                    order_item_item.name = self._get_cleaned_text(item_element.find(u'Наименование'))
-                    sku_element = item_element.find(u'БазоваяЕдиница')
-                    if sku_element is not None:
-                        order_item_item.sku.id = sku_element.get(u'Код')
-                        order_item_item.sku.name = self._get_cleaned_text(sku_element)
-                        order_item_item.sku.name_full = sku_element.get(u'НаименованиеПолное')
-                        order_item_item.sku.international_abbr = sku_element.get(u'МеждународноеСокращение')
-                    order_item_item.price = self._get_cleaned_text(item_element.find(u'ЦенаЗаЕдиницу'))
-                    order_item_item.quant = self._get_cleaned_text(item_element.find(u'Количество'))
-                    order_item_item.sum = self._get_cleaned_text(item_element.find(u'Сумма'))
-                    order_item.items.append(order_item_item)
-            additional_field_elements = order_element.find(u'ЗначенияРеквизитов/ЗначениеРеквизита')
-            if additional_field_elements is not None:
-                for additional_field_element in additional_field_elements:
-                    additional_field_item = AdditionalField(additional_field_element)
-                    additional_field_item.name = self._get_cleaned_text(item_element.find(u'Наименование'))
-                    additional_field_item.value = self._get_cleaned_text(item_element.find(u'Значение'))
-            self.item_processor.process_item(order_item)
+            logger.exception('Import orders error!')
+            raise
 
+    def _get_orders_handlers(self):
+        return {
+            (u'Документ',): self._parse_order,
+        }
 
-class ExportManager(object):
+    def _parse_order(self, order_element):
+        order_item = Order(order_element)
+        parse_children(self, order_element, order_item, ORDER_HANDLERS)
+        self.item_processor.process_item(order_item)
+
+
+class ChunkImportManager(ImportManager):
+    """
+    Parses serialized elements in a pool process and collects the items instead of processing them.
+    """
 
     def __init__(self):
+        self.results = []
+
+    def _process_if_changed(self, item, before=(), after=()):
+        # XML elements stay in the pool process
+        for related_item in (item,) + tuple(before) + tuple(after):
+            related_item.detach()
+        self.results.append((item, tuple(before), tuple(after)))
+
+
+def _parse_chunk(handler_name, chunk):
+    import_manager = ChunkImportManager()
+    handler = getattr(import_manager, handler_name)
+    etree = get_backend()
+    for data in chunk:
+        handler(etree.fromstring(data))
+    return import_manager.results
+
+
+class ExportManager(object):
+
+    def __init__(self, since=None, limit=None):
         self.item_processor = ItemProcessor()
-        self.root = ET.Element(u'КоммерческаяИнформация')
+        self.etree = get_backend(settings.CML_EXPORT_XML_BACKEND)
+        # (updated_at, id) of the last exported order, orders after it are exported up to limit
+        self.since = since
+        self.limit = limit
+        self.watermark = since
+        self.exported_ids = []
+        self.stats = {'seconds': 0, 'bytes': 0}
+        self.peak_memory = PeakMemory()
+        self.root = self.etree.Element(u'КоммерческаяИнформация')
         self.root.set(u'ВерсияСхемы', '2.05')
         self.root.set(u'ДатаФормирования', six.text_type(datetime.now().date()))
 
     def get_xml(self):
-        f = BytesIO()
-        tree = ET.ElementTree(self.root)
-        tree.write(f, encoding='windows-1251', xml_declaration=True)
-        return f.getvalue()
+        return b''.join(self.iter_xml())
+
+    def iter_xml(self):
+        """
+        Yields the windows-1251 encoded XML document by document, so nothing but
+        the current Документ is kept in memory.
+        """
+        encoder = codecs.getincrementalencoder('windows-1251')('xmlcharrefreplace')
+        # the time the client spends reading the response isn't counted
+        self.peak_memory.start()
+        try:
+            started = time.time()
+            for text in self._iter_text():
+                data = encoder.encode(text)
+                self.stats['seconds'] += time.time() - started
+                self.stats['bytes'] += len(data)
+                yield data
+                started = time.time()
+        finally:
+            self.peak_memory.stop()
+
+    def _iter_text(self):
+        attributes = u''.join(u' {}={}'.format(name, quoteattr(value)) for name, value in self.root.items())
+        yield u'<?xml version="1.0" encoding="windows-1251"?>\n<{}{}>'.format(self.root.tag, attributes)
+        for element in self.export_all():
+            yield self.etree.tostring(element, encoding='unicode')
+        yield u'</{}>'.format(self.root.tag)
+
+    def get_metrics(self):
+        """
+        Returns the metrics of the export as ExchangeMetrics fields.
+        """
+        return {
+            'seconds': self.stats['seconds'],
+            'items': len(self.exported_ids),
+            'errors': sum(self.item_processor.errors.values()),
+            'bytes': self.stats['bytes'],
+            'peak_memory': self.peak_memory.get(),
+            'section_seconds': {u'Документ': self.stats['seconds']},
+            'pipeline_seconds': dict(self.item_processor.seconds),
+            'item_counts': {u'Order': len(self.exported_ids)},
+            'error_counts': dict(self.item_processor.errors),
+        }
 
     def export_all(self):
-        self.export_orders()
+        for element in self.export_orders():
+            yield element
 
     def export_orders(self):
-        for order in self.item_processor.yield_item(Order):
-            order_element = ET.SubElement(self.root, u'Документ')
-            ET.SubElement(order_element, u'Ид').text = six.text_type(order.id)
-            ET.SubElement(order_element, u'Номер').text = six.text_type(order.number)
-            ET.SubElement(order_element, u'Дата').text = six.text_type(order.date.strftime('%Y-%m-%d'))
-            ET.SubElement(order_element, u'Время').text = six.text_type(order.time.strftime('%H:%M:%S'))
-            ET.SubElement(order_element, u'ХозОперация').text = six.text_type(order.operation)
-            ET.SubElement(order_element, u'Роль').text = six.text_type(order.role)
-            ET.SubElement(order_element, u'Валюта').text = six.text_type(order.currency_name)
-            ET.SubElement(order_element, u'Курс').text = six.text_type(order.currency_rate)
-            ET.SubElement(order_element, u'Сумма').text = six.text_type(order.sum)
-            ET.SubElement(order_element, u'Комментарий').text = six.text_type(order.comment)
-            clients_element = ET.SubElement(order_element, u'Контрагенты')
-            client_element = ET.SubElement(clients_element, u'Контрагент')
-            ET.SubElement(client_element, u'Ид').text = six.text_type(order.client.id)
-            ET.SubElement(client_element, u'Наименование').text = six.text_type(order.client.name)
-            ET.SubElement(client_element, u'Роль').text = six.text_type(order.client.role)
-            ET.SubElement(client_element, u'ПолноеНаименование').text = six.text_type(order.client.full_name)
-            ET.SubElement(client_element, u'Фамилия').text = six.text_type(order.client.last_name)
-            ET.SubElement(client_element, u'Имя').text = six.text_type(order.client.first_name)
-            address_element = ET.SubElement(clients_element, u'АдресРегистрации')
-            ET.SubElement(clients_element, u'Представление').text = six.text_type(order.client.address)
-            products_element = ET.SubElement(order_element, u'Товары')
+        for order in self.item_processor.yield_items_since(Order, self.since, self.limit):
+            if order.updated_at is not None:
+                self.watermark = (order.updated_at, six.text_type(order.id))
+            self.exported_ids.append(six.text_type(order.id))
+            order_element = self.etree.Element(u'Документ')
+            self.etree.SubElement(order_element, u'Ид').text = six.text_type(order.id)
+            self.etree.SubElement(order_element, u'Номер').text = six.text_type(order.number)
+            self.etree.SubElement(order_element, u'Дата').text = six.text_type(order.date.strftime('%Y-%m-%d'))
+            self.etree.SubElement(order_element, u'Время').text = six.text_type(order.time.strftime('%H:%M:%S'))
+            self.etree.SubElement(order_element, u'ХозОперация').text = six.text_type(order.operation)
+            self.etree.SubElement(order_element, u'Роль').text = six.text_type(order.role)
+            self.etree.SubElement(order_element, u'Валюта').text = six.text_type(order.currency_name)
+            self.etree.SubElement(order_element, u'Курс').text = six.text_type(order.currency_rate)
+            self.etree.SubElement(order_element, u'Сумма').text = six.text_type(order.sum)
+            self.etree.SubElement(order_element, u'Комментарий').text = six.text_type(order.comment)
+            clients_element = self.etree.SubElement(order_element, u'Контрагенты')
+            client_element = self.etree.SubElement(clients_element, u'Контрагент')
+            self.etree.SubElement(client_element, u'Ид').text = six.text_type(order.client.id)
+            self.etree.SubElement(client_element, u'Наименование').text = six.text_type(order.client.name)
+            self.etree.SubElement(client_element, u'Роль').text = six.text_type(order.client.role)
+            self.etree.SubElement(client_element, u'ПолноеНаименование').text = six.text_type(order.client.full_name)
+            self.etree.SubElement(client_element, u'Фамилия').text = six.text_type(order.client.last_name)
+            self.etree.SubElement(client_element, u'Имя').text = six.text_type(order.client.first_name)
+            address_element = self.etree.SubElement(client_element, u'АдресРегистрации')
+            self.etree.SubElement(address_element, u'Представление').text = six.text_type(order.client.address)
+            products_element = self.etree.SubElement(order_element, u'Товары')
             for order_item in order.items:
-                product_element = ET.SubElement(products_element, u'Товар')
-                ET.SubElement(product_element, u'Ид').text = six.text_type(order_item.id)
-                ET.SubElement(product_element, u'Наименование').text = six.text_type(order_item.name)
-                sku_element = ET.SubElement(product_element, u'БазоваяЕдиница ')
+                product_element = self.etree.SubElement(products_element, u'Товар')
+                self.etree.SubElement(product_element, u'Ид').text = six.text_type(order_item.id)
+                self.etree.SubElement(product_element, u'Наименование').text = six.text_type(order_item.name)
+                sku_element = self.etree.SubElement(product_element, u'БазоваяЕдиница')
                 sku_element.set(u'Код', order_item.sku.id)
                 sku_element.set(u'НаименованиеПолное', order_item.sku.name_full)
                 sku_element.set(u'МеждународноеСокращение', order_item.sku.international_abbr)
                 sku_element.text = order_item.sku.name
-                ET.SubElement(product_element, u'ЦенаЗаЕдиницу').text = six.text_type(order_item.price)
-                ET.SubElement(product_element, u'Количество').text = six.text_type(order_item.quant)
-                ET.SubElement(product_element, u'Сумма').text = six.text_type(order_item.sum)
+                self.etree.SubElement(product_element, u'ЦенаЗаЕдиницу').text = six.text_type(order_item.price)
+                self.etree.SubElement(product_element, u'Количество').text = six.text_type(order_item.quant)
+                self.etree.SubElement(product_element, u'Сумма').text = six.text_type(order_item.sum)
+            yield order_element
 
-    def flush(self):
-        self.item_processor.flush_pipeline(Order)
+    def flush(self, order_ids=None):
+        if order_ids is None:
+            self.item_processor.flush_pipeline(Order)
+        else:
+            self.item_processor.mark_exported(Order, order_ids)
 
 
-class ItemProcessor(object):
+class ReferenceCache(object):
+    """
+    Bounded maps of 1C ids to database primary keys, one per item type.
+    Item types are given as item classes or their names, keys are what
+    item.get_reference_key() returns. The least recently used keys are
+    dropped when a map grows over max_size.
+    """
 
-    def __init__(self):
-        self._project_pipelines = {}
-        self._load_project_pipelines()
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._references = {}
+        # the item writers share the cache
+        self._lock = threading.Lock()
 
-    def _load_project_pipelines(self):
+    def _get_references(self, item_type):
+        item_type = getattr(item_type, '__name__', item_type)
         try:
-            pipelines_module_name = settings.CML_PROJECT_PIPELINES
-        except AttributeError:
-            logger.info('Configure CML_PROJECT_PIPELINES in settings!')
-            return
+            return self._references[item_type]
+        except KeyError:
+            return self._references.setdefault(item_type, OrderedDict())
+
+    def get(self, item_type, key, default=None):
+        references = self._get_references(item_type)
+        with self._lock:
+            try:
+                pk = references[key]
+            except KeyError:
+                return default
+            references.move_to_end(key)
+        return pk
+
+    def set(self, item_type, key, pk):
+        references = self._get_references(item_type)
+        with self._lock:
+            references[key] = pk
+            references.move_to_end(key)
+            if len(references) > self.max_size:
+                references.popitem(last=False)
+
+    def update(self, item_type, pks):
+        for key, pk in pks.items():
+            self.set(item_type, key, pk)
+
+    def __len__(self):
+        return sum(len(references) for references in self._references.values())
+
+
+class ColumnBatch(object):
+    """
+    Rows of values kept as a list per column, e.g. batch.offer_ids, batch.prices.
+    Iterating over a batch yields the rows as tuples.
+    """
+
+    def __init__(self, *names):
+        self.names = names
+        self.columns = tuple([] for name in names)
+
+    def __getattr__(self, name):
         try:
-            pipelines_module = importlib.import_module(pipelines_module_name)
-        except ImportError:
+            return self.columns[self.names.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+    def append(self, *values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def empty_copy(self):
+        return ColumnBatch(*self.names)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+
+def get_pipeline_classes():
+    """
+    Returns {item class name: pipeline class} of the CML_PROJECT_PIPELINES module.
+    """
+    try:
+        pipelines_module_name = settings.CML_PROJECT_PIPELINES
+    except AttributeError:
+        logger.info('Configure CML_PROJECT_PIPELINES in settings!')
+        return {}
+    try:
+        pipelines_module = importlib.import_module(pipelines_module_name)
+    except ImportError:
+        return {}
+    pipeline_classes = {}
+    for item_class_name in PROCESSED_ITEMS:
+        try:
+            pipeline_classes[item_class_name] = getattr(pipelines_module, '{}Pipeline'.format(item_class_name))
+        except AttributeError:
+            continue
+    return pipeline_classes
+
+
+def get_item_processor():
+    # the writers can't keep xml_element, the parser clears it as soon as the item is queued
+    if settings.CML_IMPORT_WRITERS > 0 and not settings.CML_KEEP_XML_ELEMENTS:
+        return ConcurrentItemProcessor(settings.CML_IMPORT_WRITERS, settings.CML_IMPORT_QUEUE_SIZE)
+    return ItemProcessor()
+
+
+class ItemProcessor(object):
+
+    def __init__(self, references=None, item_class_names=PROCESSED_ITEMS, pipeline_classes=None):
+        self._project_pipelines = {}
+        self._buffers = {}
+        self.batch_size = settings.CML_BATCH_SIZE
+        # (item class name, item id) of the items the pipelines failed to process
+        self.failed_items = set()
+        self.processed = Counter()
+        self.errors = Counter()
+        # time spent in the pipelines by item type
+        self.seconds = Counter()
+        self.references = references if references is not None else \
+            ReferenceCache(settings.CML_REFERENCE_CACHE_SIZE)
+        self._references_loaded = False
+        self._price_batch = ColumnBatch('offer_ids', 'price_type_ids', 'prices', 'currencies')
+        self._stock_batch = ColumnBatch('offer_ids', 'quantities')
+        self.transaction_chunk_size = settings.CML_TRANSACTION_CHUNK_SIZE
+        self._transaction = None
+        self._transaction_started = None
+        self._transaction_items = 0
+        # (started, seconds it was open, seconds its commit took) of every committed chunk
+        self.commits = []
+        self._load_project_pipelines(item_class_names, pipeline_classes)
+
+    def _load_project_pipelines(self, item_class_names, pipeline_classes=None):
+        if pipeline_classes is None:
+            pipeline_classes = get_pipeline_classes()
+        for item_class_name in item_class_names:
+            pipeline_class = pipeline_classes.get(item_class_name)
+            if pipeline_class is None:
+                continue
+            project_pipeline = pipeline_class()
+            if hasattr(project_pipeline, 'set_reference_cache'):
+                project_pipeline.set_reference_cache(self.references)
+            self._project_pipelines[item_class_name] = project_pipeline
+
+    def preload_references(self):
+        """
+        Fills the reference cache from the pipelines' preload_references() once per processor.
+        """
+        if self._references_loaded:
             return
+        self._references_loaded = True
         for item_class_name in PROCESSED_ITEMS:
-            try:
-                pipeline_class = getattr(pipelines_module, '{}Pipeline'.format(item_class_name))
-            except AttributeError:
+            project_pipeline = self._project_pipelines.get(item_class_name)
+            if not hasattr(project_pipeline, 'preload_references'):
                 continue
-            self._project_pipelines[item_class_name] = pipeline_class()
+            try:
+                self.references.update(item_class_name, project_pipeline.preload_references())
+            except Exception as e:
+                logger.error('Error preloading references {}: {}'.format(item_class_name, repr(e)))
 
     def _get_project_pipeline(self, item_class):
         item_class_name = item_class.__name__
@@ -348,11 +1302,153 @@ class ItemProcessor(object):
 
     def process_item(self, item):
         project_pipeline = self._get_project_pipeline(item.__class__)
-        if project_pipeline:
+        if not project_pipeline:
+            return
+        item_class_name = item.__class__.__name__
+        self.processed[item_class_name] += 1
+        if hasattr(project_pipeline, 'process_items'):
+            items = self._buffers.setdefault(item_class_name, [])
+            items.append(item)
+            if len(items) >= self.batch_size:
+                self._flush_buffers()
+            return
+        if self._buffers:
+            self._flush_items_before(item_class_name)
+        try:
+            pk = self._call_pipeline(item_class_name, 1, project_pipeline.process_item, item)
+        except Exception as e:
+            logger.error('Error processing of item {}: {}'.format(item_class_name, repr(e)))
+            self.failed_items.add((item_class_name, getattr(item, 'id', None)))
+            self.errors[item_class_name] += 1
+            return
+        if pk is not None:
+            self.references.set(item_class_name, item.get_reference_key(), pk)
+
+    def _flush_items_before(self, item_class_name):
+        # items of the preceding types may be referenced by this one, so they are stored first
+        for preceding_class_name in PROCESSED_ITEMS[:PROCESSED_ITEMS.index(item_class_name)]:
+            if preceding_class_name in self._buffers:
+                self._process_items(preceding_class_name, self._buffers.pop(preceding_class_name))
+
+    def flush_items(self):
+        self._flush_buffers()
+        # everything flushed is stored once this returns, e.g. before a checkpoint moves past it
+        self.commit()
+
+    def _flush_buffers(self):
+        for item_class_name in PROCESSED_ITEMS:
+            if item_class_name in self._buffers:
+                self._process_items(item_class_name, self._buffers.pop(item_class_name))
+        self._flush_offer_updates()
+
+    def _call_pipeline(self, item_class_name, items_count, method, *args):
+        """
+        Calls the pipeline method within the open chunk transaction (or the caller's one)
+        in a savepoint, so an error rolls back only what that call did.
+        """
+        self._begin_chunk()
+        started = time.time()
+        try:
+            if not connection.in_atomic_block:
+                return method(*args)
+            with transaction.atomic():
+                return method(*args)
+        finally:
+            self.seconds[item_class_name] += time.time() - started
+            if self._transaction is not None:
+                self._transaction_items += items_count
+                if self._transaction_items >= self.transaction_chunk_size:
+                    self.commit()
+
+    def _begin_chunk(self):
+        if not self.transaction_chunk_size or self._transaction is not None or connection.in_atomic_block:
+            # off, or the caller manages the transaction
+            return
+        self._transaction = transaction.atomic()
+        self._transaction.__enter__()
+        self._transaction_started = time.time()
+        self._transaction_items = 0
+
+    def commit(self):
+        """
+        Commits the chunk transaction if one is open.
+        """
+        if self._transaction is None:
+            return
+        atomic, self._transaction = self._transaction, None
+        commit_started = time.time()
+        atomic.__exit__(None, None, None)
+        committed = time.time()
+        self.commits.append((self._transaction_started, committed - self._transaction_started,
+                             committed - commit_started))
+
+    def can_update_offers(self, prices=False, stocks=False):
+        """
+        Returns True if the offer pipeline updates the prices and the stocks asked for,
+        or with no arguments, if it updates any of them.
+        """
+        project_pipeline = self._project_pipelines.get('Offer')
+        can_update_prices = hasattr(project_pipeline, 'update_prices')
+        can_update_stocks = hasattr(project_pipeline, 'update_stocks')
+        if not prices and not stocks:
+            return can_update_prices or can_update_stocks
+        return (can_update_prices or not prices) and (can_update_stocks or not stocks)
+
+    def update_offer(self, offer_id, prices, quantity):
+        """
+        Adds the (price_type_id, price_for_sku, currency_name) prices and the stock
+        quantity (or None) of an offer to the batches of the offer pipeline's
+        update_prices(batch) and update_stocks(batch).
+        """
+        self.processed['Offer'] += 1
+        for price_type_id, price_for_sku, currency_name in prices:
+            self._price_batch.append(offer_id, price_type_id, price_for_sku, currency_name)
+        if quantity is not None:
+            self._stock_batch.append(offer_id, quantity)
+        if len(self._price_batch) >= self.batch_size or len(self._stock_batch) >= self.batch_size:
+            self._flush_offer_updates()
+
+    def _flush_offer_updates(self):
+        if not self._price_batch and not self._stock_batch:
+            return
+        # the price types go first
+        self._flush_items_before('Offer')
+        project_pipeline = self._project_pipelines['Offer']
+        for method_name, batch in (('update_prices', self._price_batch), ('update_stocks', self._stock_batch)):
+            if not batch or not hasattr(project_pipeline, method_name):
+                continue
             try:
-                project_pipeline.process_item(item)
+                self._call_pipeline('Offer', len(batch), getattr(project_pipeline, method_name), batch)
             except Exception as e:
-                logger.error('Error processing of item {}: {}'.format(item.__class__.__name__, repr(e)))
+                logger.error('Error in {} of {} offers: {}'.format(method_name, len(batch), repr(e)))
+                self.failed_items.update(('Offer', offer_id) for offer_id in batch.offer_ids)
+                self.errors['Offer'] += len(batch)
+        self._price_batch = self._price_batch.empty_copy()
+        self._stock_batch = self._stock_batch.empty_copy()
+
+    def _process_items(self, item_class_name, items):
+        project_pipeline = self._project_pipelines[item_class_name]
+        try:
+            pks = self._call_pipeline(item_class_name, len(items), project_pipeline.process_items, items)
+        except Exception as e:
+            if len(items) > 1 and (self.transaction_chunk_size or connection.in_atomic_block):
+                # the batch is rolled back to its savepoint, the bad items fail one by one
+                logger.error('Error processing of {} items {}, retrying them one by one: {}'.format(
+                    len(items), item_class_name, repr(e)))
+                for item in items:
+                    self._process_items(item_class_name, [item])
+                return
+            logger.error('Error processing of {} items {}: {}'.format(len(items), item_class_name, repr(e)))
+            self.failed_items.update((item_class_name, getattr(item, 'id', None)) for item in items)
+            self.errors[item_class_name] += len(items)
+            return
+        # either a list of primary keys in the order of items or a dict by reference keys
+        if isinstance(pks, dict):
+            self.references.update(item_class_name, pks)
+        elif pks is not None:
+            for item, pk in zip(items, pks):
+                if pk is not None:
+                    self.references.set(item_class_name, item.get_reference_key(), pk)
 
     def yield_item(self, item_class):
         project_pipeline = self._get_project_pipeline(item_class)
@@ -361,9 +1457,47 @@ class ItemProcessor(object):
                 return project_pipeline.yield_item()
             except Exception as e:
                 logger.error('Error yielding item {}: {}'.format(item_class.__name__, repr(e)))
+                self.errors[item_class.__name__] += 1
                 return []
         return []
 
+    def yield_items_since(self, item_class, since, limit):
+        """
+        Uses the pipeline's yield_items(since, limit) if there is one,
+        otherwise falls back to yield_item() which yields everything.
+        """
+        project_pipeline = self._get_project_pipeline(item_class)
+        if not hasattr(project_pipeline, 'yield_items'):
+            return self.yield_item(item_class)
+        try:
+            return project_pipeline.yield_items(since, limit)
+        except Exception as e:
+            logger.error('Error yielding items {}: {}'.format(item_class.__name__, repr(e)))
+            self.errors[item_class.__name__] += 1
+            return []
+
+    def get_image_paths(self):
+        """
+        Returns the image_path of every product from the pipeline's get_image_paths(),
+        or None if it has none.
+        """
+        project_pipeline = self._get_project_pipeline(Product)
+        if not hasattr(project_pipeline, 'get_image_paths'):
+            return None
+        return project_pipeline.get_image_paths()
+
+    def mark_exported(self, item_class, item_ids):
+        """
+        Uses the pipeline's mark_exported(item_ids) if there is one, otherwise flush().
+        """
+        project_pipeline = self._get_project_pipeline(item_class)
+        if not hasattr(project_pipeline, 'mark_exported'):
+            return self.flush_pipeline(item_class)
+        try:
+            project_pipeline.mark_exported(item_ids)
+        except Exception as e:
+            logger.error('Error marking exported items {}: {}'.format(item_class.__name__, repr(e)))
+
     def flush_pipeline(self, item_class):
         project_pipeline = self._get_project_pipeline(item_class)
         if project_pipeline:
@@ -371,3 +1505,136 @@ class ItemProcessor(object):
                 project_pipeline.flush()
             except Exception as e:
                 logger.error('Error flushing pipeline for item {}: {}'.format(item_class.__name__, repr(e)))
+
+
+class ItemWriter(threading.Thread):
+    """
+    Makes the queued item processor calls one by one in its own thread.
+    After an error the calls are skipped, the error is raised by the next call queued.
+    """
+
+    def __init__(self, item_processor, queue_size):
+        super(ItemWriter, self).__init__()
+        self.daemon = True
+        self.item_processor = item_processor
+        self.calls = queue.Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                call = self.calls.get()
+                try:
+                    if call is None:
+                        return
+                    if self.error is None:
+                        method_name, args = call
+                        getattr(self.item_processor, method_name)(*args)
+                except Exception as e:
+                    logger.error('Item writer error: {}'.format(repr(e)))
+                    self.error = e
+                finally:
+                    self.calls.task_done()
+        finally:
+            # the connections of this thread
+            connections.close_all()
+
+
+class ConcurrentItemProcessor(object):
+    """
+    ItemProcessor for imports with the pipelines called by writer threads, so the
+    file is parsed while the pipelines wait on the database. The types of a
+    WRITER_GROUPS group are written by one writer in the order of the file; the
+    parser waits while a writer has queue_size calls queued. Items of the groups of
+    different writers may be written in any order between flushes. Until start() and after stop() the calls
+    are made right away by the calling thread.
+    """
+
+    def __init__(self, writers, queue_size):
+        self.queue_size = queue_size
+        self.references = ReferenceCache(settings.CML_REFERENCE_CACHE_SIZE)
+        pipeline_classes = get_pipeline_classes()
+        groups = [[name for name in group if name in pipeline_classes] for group in WRITER_GROUPS]
+        groups = [group for group in groups if group]
+        writers = max(min(writers, len(groups)), 1)
+        self._item_processors = []
+        for index in range(writers):
+            item_class_names = [name for group in groups[index::writers] for name in group]
+            self._item_processors.append(ItemProcessor(self.references, item_class_names, pipeline_classes))
+        self._item_processor_by_type = {}
+        for item_processor in self._item_processors:
+            for item_class_name in item_processor._project_pipelines:
+                self._item_processor_by_type[item_class_name] = item_processor
+        self._writers = None
+
+    @property
+    def failed_items(self):
+        return set().union(*(item_processor.failed_items for item_processor in self._item_processors))
+
+    @property
+    def processed(self):
+        return sum((item_processor.processed for item_processor in self._item_processors), Counter())
+
+    @property
+    def errors(self):
+        return sum((item_processor.errors for item_processor in self._item_processors), Counter())
+
+    @property
+    def seconds(self):
+        return sum((item_processor.seconds for item_processor in self._item_processors), Counter())
+
+    @property
+    def commits(self):
+        return [commit for item_processor in self._item_processors for commit in item_processor.commits]
+
+    def start(self):
+        self._writers = {}
+        for item_processor in self._item_processors:
+            writer = self._writers[item_processor] = ItemWriter(item_processor, self.queue_size)
+            writer.start()
+
+    def stop(self):
+        writers, self._writers = self._writers, None
+        for writer in writers.values():
+            writer.calls.put(None)
+        for writer in writers.values():
+            writer.join()
+
+    def _call(self, item_processor, method_name, *args):
+        if self._writers is None:
+            return getattr(item_processor, method_name)(*args)
+        writer = self._writers[item_processor]
+        if writer.error is not None:
+            raise writer.error
+        # blocks while the writer is queue_size calls behind
+        writer.calls.put((method_name, args))
+
+    def preload_references(self):
+        for item_processor in self._item_processors:
+            self._call(item_processor, 'preload_references')
+
+    def process_item(self, item):
+        item_processor = self._item_processor_by_type.get(item.__class__.__name__)
+        if item_processor is not None:
+            self._call(item_processor, 'process_item', item)
+
+    def can_update_offers(self, prices=False, stocks=False):
+        item_processor = self._item_processor_by_type.get('Offer')
+        return item_processor is not None and item_processor.can_update_offers(prices, stocks)
+
+    def update_offer(self, offer_id, prices, quantity):
+        self._call(self._item_processor_by_type['Offer'], 'update_offer', offer_id, prices, quantity)
+
+    def flush_items(self):
+        """
+        Returns once every writer has written the items queued before the call.
+        """
+        for item_processor in self._item_processors:
+            self._call(item_processor, 'flush_items')
+        if self._writers is None:
+            return
+        for writer in self._writers.values():
+            writer.calls.join()
+        for writer in self._writers.values():
+            if writer.error is not None:
+                raise writer.error
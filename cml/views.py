@@ -1,17 +1,32 @@
 from __future__ import absolute_import
-from django.http import Http404
+import io
+import time
+from datetime import timedelta
+from functools import partial
+from django.db import transaction
+from django.utils import timezone
+from django.http import Http404, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.uploadedfile import SimpleUploadedFile
 from .auth import *
 from .utils import *
 from .models import *
+from .scheduler import *
+from .tasks import start_package, wait_import
+from .recording import ExchangeRecorder
 
 logger = logging.getLogger(__name__)
 
+# the exchange whose init marks the import tasks of the type reported
+IMPORT_EXCHANGE_TYPES = {
+    u'catalog': u'catalog',
+    u'import': u'sale',
+}
+
 
 @csrf_exempt
-@has_perm_or_basicauth('cml.add_exchange')
-@logged_in_or_basicauth()
+# the lane slots have to be seen by the other processes while the request runs
+@transaction.non_atomic_requests
+@has_perm_or_exchange_token('cml.add_exchange')
 def front_view(request):
     return Dispatcher().dispatch(request)
 
@@ -27,13 +42,35 @@ def success(request, success_test=''):
     return HttpResponse(result)
 
 
+def progress(request, progress_text=''):
+    result = '{}\n{}'.format(settings.CML_RESPONSE_PROGRESS, progress_text)
+    return HttpResponse(result)
+
+
+def busy(request, lane):
+    logger.info('Lane {} is full'.format(lane))
+    response = HttpResponse('{}\nBusy, try again later'.format(settings.CML_RESPONSE_ERROR), status=503)
+    response['Retry-After'] = '{}'.format(settings.CML_MAX_EXEC_TIME)
+    return response
+
+
 def check_auth(request):
-    session = request.session
-    success_text = '{}\n{}'.format(settings.SESSION_COOKIE_NAME, session.session_key)
-    return success(success_text)
+    # 1C sends the token back as a cookie with every request of the exchange
+    token = issue_exchange_token(request.user)
+    # the session of the exchange
+    request.cml_token = token
+    success_text = '{}\n{}'.format(settings.CML_TOKEN_COOKIE_NAME, token)
+    return success(request, success_text)
 
 
 def init(request):
+    # parts of the exchanges whose tokens have expired can't be completed
+    remove_partial_uploads(settings.CML_TOKEN_TIMEOUT)
+    UploadedFile.objects.filter(updated__lt=timezone.now() - timedelta(seconds=settings.CML_TOKEN_TIMEOUT)).delete()
+    # the results of the other exchange may be yet to be asked for
+    ImportTask.objects.filter(exchange_type=request.GET.get('type'), is_reported=False,
+                              status__in=(ImportTask.STATUS_SUCCESS,
+                                          ImportTask.STATUS_FAILURE)).update(is_reported=True)
     result = 'zip={}\nfile_limit={}'.format('yes' if settings.CML_USE_ZIP else 'no',
                                             settings.CML_FILE_LIMIT)
     return HttpResponse(result)
@@ -52,10 +89,24 @@ def upload_file(request):
         except OSError:
             return error(request, 'Can\'t create upload directory!')
     filename = os.path.basename(filename)
-    temp_file = SimpleUploadedFile(filename, request.read(), content_type='text/xml')
-    with open(os.path.join(settings.CML_UPLOAD_ROOT, filename), 'wb') as f:
-        for chunk in temp_file.chunks():
-            f.write(chunk)
+    file_path = os.path.join(settings.CML_UPLOAD_ROOT, filename)
+    session_key = get_exchange_session_key(request)
+    try:
+        expected_size = int(request.META['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        expected_size = None
+    try:
+        written = append_upload(request, file_path, session_key, expected_size)
+    except Exception as e:
+        return error(request, 'Can\'t write file part: {}'.format(repr(e)))
+    if session_key:
+        UploadedFile.objects.update_or_create(session_key=session_key, filename=filename)
+    # 1C splits files by CML_FILE_LIMIT, so a shorter part is the last one
+    if not settings.CML_FILE_LIMIT or written < settings.CML_FILE_LIMIT:
+        try:
+            finalize_upload(file_path, session_key)
+        except Exception as e:
+            return error(request, 'Can\'t finalize file: {}'.format(repr(e)))
     return success(request)
 
 
@@ -64,38 +115,136 @@ def import_file(request):
         filename = request.GET['filename']
     except KeyError:
         return error(request, 'Need a filename param!')
-    file_path = os.path.join(settings.CML_UPLOAD_ROOT, filename)
-    if not os.path.exists(file_path):
-        return error(request, 'File does\'nt exists!')
-    import_manager = ImportManager(file_path, )
-    try:
-        import_manager.import_all()
-    except Exception as e:
-        return error(request, str(e))
-    if settings.CML_DELETE_FILES_AFTER_IMPORT:
+    lane = get_lane((request.GET.get('type'), request.GET.get('mode')))
+    exchange_type = IMPORT_EXCHANGE_TYPES.get(request.GET.get('type'), u'')
+    # the slot of the request goes to the package it starts, there is none if the lane is full
+    lane_slot = getattr(request, 'cml_lane_slot', None)
+    import_task = ImportTask.get_unreported(filename)
+    if import_task is not None and lane_slot is not None:
+        stale_tasks = import_task.get_stale_tasks()
+        if stale_tasks:
+            import_task = restart_tasks(stale_tasks, import_task, lane, lane_slot)
+            request.cml_lane_slot = None
+    if import_task is None:
+        if lane_slot is None:
+            # 1C asks again, the import starts once a slot is free
+            return progress(request, '0%')
+        file_path = os.path.join(settings.CML_UPLOAD_ROOT, filename)
+        session_key = get_exchange_session_key(request)
         try:
-            os.remove(file_path)
-        except OSError:
-            logger.error('Can\'t delete file after import: {}'.format(file_path))
-    Exchange.log('import', request.user, filename)
+            # the last part could have been exactly CML_FILE_LIMIT bytes long
+            finalize_uploads(session_key)
+        except Exception as e:
+            return error(request, 'Can\'t finalize file: {}'.format(repr(e)))
+        archive_path = None
+        if not os.path.exists(file_path) and settings.CML_USE_ZIP:
+            # the file was sent inside a zip package, import it without unpacking
+            archive_path, member_name = find_archive_member(os.path.basename(filename))
+            if archive_path is not None:
+                file_path = member_name
+        if archive_path is None and not os.path.exists(file_path):
+            return error(request, 'File does\'nt exists!')
+        import_task = ImportTask.objects.create(filename=filename, file_path=file_path,
+                                                archive_path=archive_path or u'', user=request.user,
+                                                session_key=session_key, exchange_type=exchange_type)
+        start_package([import_task] + create_package_tasks(request.user, session_key, import_task), lane, lane_slot)
+        request.cml_lane_slot = None
+    # 1C repeats the call while it gets "progress", so never hold the worker longer than that
+    should_stop = None
+    if lane == CATALOG_LANE:
+        # the orders go first
+        should_stop = partial(is_lane_busy, SALE_LANE)
+    import_task = wait_import(import_task, getattr(request, 'cml_wait_time', settings.CML_MAX_EXEC_TIME),
+                              should_stop)
+    if not import_task.is_finished:
+        return progress(request, '{}%'.format(import_task.progress))
+    import_task.is_reported = True
+    import_task.save(update_fields=['is_reported'])
+    if import_task.status == ImportTask.STATUS_FAILURE:
+        return error(request, import_task.message)
     return success(request)
 
 
+def create_package_tasks(user, session_key, import_task):
+    """
+    1C uploads the whole package before it asks to import the first file, so the files
+    the session uploaded and hasn't asked for yet are imported along with that one.
+    """
+    if not session_key or ImportTask.objects.filter(session_key=session_key).exclude(pk=import_task.pk).exists():
+        # the package is being imported already
+        return []
+    import_tasks = []
+    filenames = UploadedFile.get_filenames(session_key)
+    UploadedFile.objects.filter(session_key=session_key).delete()
+    for filename, file_path, archive_path in find_package_files(filenames):
+        if filename == import_task.filename:
+            continue
+        import_tasks.append(ImportTask.objects.create(filename=filename, file_path=file_path,
+                                                      archive_path=archive_path or u'', user=user,
+                                                      session_key=session_key,
+                                                      exchange_type=import_task.exchange_type))
+    return import_tasks
+
+
+def restart_tasks(stale_tasks, import_task, lane, lane_slot=None):
+    """
+    Fails the tasks left by a dead worker and imports their files again, the checkpoints
+    let them continue where it stopped. Returns the new task of the file of import_task.
+    """
+    logger.error('Import tasks {} stopped responding, importing them again'.format(
+        [stale_task.pk for stale_task in stale_tasks]))
+    ImportTask.objects.filter(pk__in=[stale_task.pk for stale_task in stale_tasks]).update(
+        status=ImportTask.STATUS_FAILURE, message='Stopped responding, imported again', is_reported=True)
+    new_tasks = []
+    for stale_task in stale_tasks:
+        new_task = ImportTask.objects.create(filename=stale_task.filename, file_path=stale_task.file_path,
+                                             archive_path=stale_task.archive_path, user=stale_task.user,
+                                             session_key=stale_task.session_key,
+                                             exchange_type=stale_task.exchange_type)
+        new_tasks.append(new_task)
+        if stale_task.pk == import_task.pk:
+            import_task = new_task
+    start_package(new_tasks, lane, lane_slot)
+    return import_task
+
+
 def export_query(request):
-    export_manager = ExportManager()
-    export_manager.export_all()
-    return HttpResponse(export_manager.get_xml(), content_type='text/xml')
+    watermark = Exchange.get_export_watermark()
+    export_manager = ExportManager(since=watermark, limit=settings.CML_EXPORT_BATCH_SIZE)
+
+    def stream():
+        for chunk in export_manager.iter_xml():
+            yield chunk
+        # confirmed by sale/success, until then the next query starts from the same watermark
+        watermark_at, watermark_id = export_manager.watermark or (None, u'')
+        ex_log = Exchange.log('export', request.user, session_key=get_exchange_session_key(request),
+                              is_confirmed=False, watermark=watermark_at, watermark_id=watermark_id,
+                              exported_ids=u'\n'.join(export_manager.exported_ids))
+        ExchangeMetrics.record(ex_log, export_manager.get_metrics())
+
+    return StreamingHttpResponse(stream(), content_type='text/xml')
 
 
 def export_success(request):
     export_manager = ExportManager()
-    Exchange.log('export', request.user)
-    export_manager.flush()
+    with transaction.atomic():
+        ex_log = Exchange.get_pending_export(request.user, get_exchange_session_key(request))
+        if ex_log is None:
+            logger.info('No export to confirm for {}'.format(request.user))
+            return success(request)
+        ex_log.is_confirmed = True
+        ex_log.save(update_fields=['is_confirmed'])
+        # exports of the repeated queries were superseded by the confirmed one
+        Exchange.objects.filter(exchange_type='export', is_confirmed=False, user=request.user,
+                                session_key=ex_log.session_key, pk__lt=ex_log.pk).delete()
+        export_manager.flush(ex_log.get_exported_ids())
     return success(request)
 
 
 class Dispatcher(object):
 
+    recorder = None
+
     def __init__(self):
         self.routes_map = {
             (u'catalog', u'checkauth'): check_auth,
@@ -111,8 +260,46 @@ class Dispatcher(object):
         }
 
     def dispatch(self, request):
+        if not settings.CML_RECORD_ROOT:
+            return self.dispatch_scheduled(request)
+        if Dispatcher.recorder is None or Dispatcher.recorder.bundle_dir != settings.CML_RECORD_ROOT:
+            Dispatcher.recorder = ExchangeRecorder(settings.CML_RECORD_ROOT)
+        # a file part is up to CML_FILE_LIMIT, it's kept in memory for the recorder and
+        # the view reads it from there, request.body would be limited by DATA_UPLOAD_MAX_MEMORY_SIZE
+        body = request.read()
+        request._stream = io.BytesIO(body)
+        started = time.time()
+        response = self.dispatch_scheduled(request)
+        try:
+            Dispatcher.recorder.record(request, body, response, get_exchange_session_key(request),
+                                       started, time.time() - started)
+        except Exception as e:
+            logger.error('Can\'t record exchange request: {}'.format(repr(e)))
+        return response
+
+    def dispatch_scheduled(self, request):
         view_key = (request.GET.get('type'), request.GET.get('mode'))
         view = self.routes_map.get(view_key)
         if not view:
             raise Http404
-        return view(request)
+        lane = get_lane(view_key)
+        if lane is None:
+            return view(request)
+        slot = acquire_lane_slot(lane)
+        if slot is None:
+            if view is not import_file:
+                return busy(request, lane)
+            # the running imports are checked, but no new one is started and the worker isn't held
+            request.cml_wait_time = 0
+            return view(request)
+        request.cml_lane_slot = slot
+        try:
+            response = view(request)
+        except Exception:
+            if request.cml_lane_slot is not None:
+                release_lane_slot(lane, slot)
+            raise
+        if request.cml_lane_slot is None:
+            # an import package holds the slot until it's done
+            return response
+        return release_lane_slot_after(response, lane, slot)
@@ -0,0 +1,4 @@
+from __future__ import absolute_import, unicode_literals
+from run_celery import app as celery_app
+
+__all__ = ('celery_app',)
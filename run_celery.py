@@ -5,4 +5,5 @@ from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.base')
 app = Celery('del_mir_backend')
-app.config_from_object('django.conf:settings', namespace='CELERY')
\ No newline at end of file
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()